@@ -0,0 +1,354 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    Stream the members of RPM, cpio, tar (optionally compressed) and zip/jar
+    archives through the file type classifier and the ELF reader without
+    extracting anything to disk. Members are recorded as 'archive!member'.
+"""
+
+import os
+import bz2
+import zlib
+import zipfile
+import tarfile
+import subprocess
+import cStringIO
+import rpm
+
+import elf_reader
+import filetype
+import rpm_index
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+class ArchiveError(Exception): pass
+
+# separates the archive path from the member path in Filedata.full_path
+MEMBER_SEP = "!"
+
+ARCHIVE_TYPES = ("RPM", "CPIO", "TAR", "GZIP", "BZIP2", "XZ", "ZIP")
+# compressed streams, which are only archives if they hold a tar or cpio
+COMPRESSED_TYPES = {"GZIP": "gzip", "BZIP2": "bzip2", "XZ": "xz"}
+
+# members are read into memory to be analyzed. Without --max-size, larger
+# ones are recorded as skipped.
+DEFAULT_MEMBER_MAX_SIZE = 128 * 1024 * 1024
+
+# decompressors that python 2 does not have built in
+external_decompressors = {
+    "xz": ["xz", "-dc"],
+    "lzma": ["xz", "-dc", "--format=lzma"],
+    "zstd": ["zstd", "-dc"],
+    }
+
+def container_path(full_path):
+    """the path of the file on disk for a possibly 'archive!member' path"""
+    return full_path.split(MEMBER_SEP, 1)[0]
+
+class StreamDecompressor(object):
+    """file-like wrapper that decompresses gzip or bzip2 data as it is read"""
+    def __init__(self, fileobj, kind):
+        self.fileobj = fileobj
+        if kind == "gzip":
+            self.decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif kind == "bzip2":
+            self.decomp = bz2.BZ2Decompressor()
+        else:
+            raise ArchiveError("unsupported compression: %s" % kind)
+        self.buf = ""
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            data = self.fileobj.read(256 * 1024)
+            if not data:
+                self.eof = True
+                break
+            try:
+                self.buf = self.buf + self.decomp.decompress(data)
+            except EOFError, e:
+                # bzip2 stream ended
+                self.eof = True
+        if size < 0:
+            ret, self.buf = self.buf, ""
+        else:
+            ret, self.buf = self.buf[:size], self.buf[size:]
+        return ret
+
+    def close(self):
+        self.fileobj.close()
+
+class PipeDecompressor(object):
+    """decompress through an external program reading from fileobj"""
+    def __init__(self, fileobj, cmd):
+        null = open("/dev/null", "w")
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=fileobj, stdout=subprocess.PIPE, stderr=null)
+        finally:
+            null.close()
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.fileobj.close()
+
+def open_decompressed(fileobj, kind):
+    if kind in (None, "", "none", "identity"):
+        return fileobj
+    if kind in external_decompressors:
+        return PipeDecompressor(fileobj, external_decompressors[kind])
+    return StreamDecompressor(fileobj, kind)
+
+def member_max_size(max_size):
+    """the largest member that may be read into memory"""
+    return max_size or DEFAULT_MEMBER_MAX_SIZE
+
+def payload_type(start):
+    """'TAR' or 'CPIO' for the first bytes of an uncompressed archive, or
+    None for anything else"""
+    if start[:6] in ("070701", "070702"):
+        return "CPIO"
+    if len(start) >= 512:
+        try:
+            tarfile.TarInfo.frombuf(start[:512])
+            return "TAR"
+        except tarfile.TarError, e:
+            pass
+    return None
+
+decorate(traceLog())
+def compressed_payload(path, ftype):
+    """'TAR' or 'CPIO' if the compressed file at path holds one, else None"""
+    try:
+        fileobj = open(path, "rb")
+        try:
+            stream = open_decompressed(fileobj, COMPRESSED_TYPES[ftype])
+        except OSError, e:
+            fileobj.close()
+            raise
+        try:
+            return payload_type(_read_upto(stream, 512))
+        finally:
+            stream.close()
+    except (zlib.error, IOError, OSError, EOFError), e:
+        moduleLogVerbose.debug("could not look into %s: %s" % (path, e))
+        return None
+
+decorate(traceLog())
+def is_archive(path, ftype):
+    """should the file at path, of type ftype, be scanned as an archive?"""
+    if ftype in COMPRESSED_TYPES:
+        return compressed_payload(path, ftype) is not None
+    return ftype in ARCHIVE_TYPES
+
+def _read_upto(fileobj, size):
+    chunks = []
+    while size > 0:
+        data = fileobj.read(size)
+        if not data:
+            break
+        chunks.append(data)
+        size = size - len(data)
+    return "".join(chunks)
+
+def _read_exact(fileobj, size):
+    chunks = []
+    while size > 0:
+        data = fileobj.read(min(size, 1024 * 1024))
+        if not data:
+            raise ArchiveError("unexpected end of archive")
+        chunks.append(data)
+        size = size - len(data)
+    return "".join(chunks)
+
+def _skip(fileobj, size):
+    while size > 0:
+        data = fileobj.read(min(size, 1024 * 1024))
+        if not data:
+            raise ArchiveError("unexpected end of archive")
+        size = size - len(data)
+
+decorate(traceLog())
+def iter_cpio(fileobj, max_size):
+    """yield (name, content) for regular files in a 'newc' cpio stream.
+    content is None for members larger than max_size."""
+    while True:
+        header = _read_exact(fileobj, 110)
+        if header[:6] not in ("070701", "070702"):
+            raise ArchiveError("unsupported cpio format: %r" % header[:6])
+        fields = [ int(header[6 + i*8:14 + i*8], 16) for i in range(13) ]
+        mode, filesize, namesize = fields[1], fields[6], fields[11]
+        name = _read_exact(fileobj, namesize)[:-1]
+        _skip(fileobj, (4 - (110 + namesize) % 4) % 4)
+        if name == "TRAILER!!!":
+            return
+        padding = (4 - filesize % 4) % 4
+        # regular files only
+        if mode & 0170000 == 0100000 and filesize:
+            if max_size and filesize > max_size:
+                _skip(fileobj, filesize)
+                content = None
+            else:
+                content = _read_exact(fileobj, filesize)
+            yield (name, content, filesize)
+        else:
+            _skip(fileobj, filesize)
+        _skip(fileobj, padding)
+
+decorate(traceLog())
+def iter_tar(fileobj, max_size):
+    tf = tarfile.open(fileobj=fileobj, mode="r|")
+    for member in tf:
+        if not member.isfile() or not member.size:
+            continue
+        if max_size and member.size > max_size:
+            yield (member.name, None, member.size)
+        else:
+            yield (member.name, tf.extractfile(member).read(), member.size)
+
+decorate(traceLog())
+def iter_zip(path, max_size):
+    zf = zipfile.ZipFile(path)
+    try:
+        for info in zf.infolist():
+            if info.filename.endswith("/") or not info.file_size:
+                continue
+            if max_size and info.file_size > max_size:
+                yield (info.filename, None, info.file_size)
+            else:
+                yield (info.filename, zf.read(info.filename), info.file_size)
+    finally:
+        zf.close()
+
+decorate(traceLog())
+def read_rpm_header(fileobj):
+    """read the lead, signature and header of an RPM, leaving fileobj at
+    the start of the payload"""
+    ts = rpm.TransactionSet()
+    ts.setVSFlags(-1)
+    return ts.hdrFromFdno(fileobj.fileno())
+
+def _closing(members, stream):
+    """yield from members, closing stream (and so waiting for a
+    decompressor process) however the iteration ends"""
+    try:
+        for member in members:
+            yield member
+    finally:
+        stream.close()
+
+decorate(traceLog())
+def iter_archive(path, ftype, max_size):
+    """returns (package data, member iterator) for the archive at path.
+    package data holds tags that apply to every member (eg. the RPM license).
+    Close the iterator if it is not run to the end."""
+    max_size = member_max_size(max_size)
+    if ftype == "ZIP":
+        return ({}, iter_zip(path, max_size))
+
+    fileobj = open(path, "rb")
+    if ftype == "RPM":
+        try:
+            h = read_rpm_header(fileobj)
+            # hdrFromFdno moved the OS level file offset; start a new file
+            # object there so that no stdio buffering gets in the way
+            payload = os.fdopen(os.dup(fileobj.fileno()), "rb")
+        finally:
+            fileobj.close()
+        compressor = h['payloadcompressor'] or "gzip"
+        stream = open_decompressed(payload, compressor)
+        return ({"LICENSE_RPM": h['license'], "RPM_NEVRA": rpm_index.header_nevra(h)}, _closing(iter_cpio(stream, max_size), stream))
+    if ftype == "CPIO":
+        return ({}, _closing(iter_cpio(fileobj, max_size), fileobj))
+    if ftype == "TAR":
+        return ({}, _closing(iter_tar(fileobj, max_size), fileobj))
+    if ftype in COMPRESSED_TYPES:
+        fileobj.close()
+        payload = compressed_payload(path, ftype)
+        if payload is None:
+            raise ArchiveError("%s data that is not a tar or cpio archive" % ftype)
+        stream = open_decompressed(open(path, "rb"), COMPRESSED_TYPES[ftype])
+        if payload == "CPIO":
+            return ({}, _closing(iter_cpio(stream, max_size), stream))
+        return ({}, _closing(iter_tar(stream, max_size), stream))
+    fileobj.close()
+    raise ArchiveError("not an archive type: %s" % ftype)
+
+def member_path(name):
+    """absolute, normalized path for a member name like './usr/bin/ls'"""
+    return os.path.normpath("/" + name.lstrip("/"))
+
+decorate(traceLog())
+def member_tags(opts, content, size):
+    """return the gather data keys for a file held in memory (content is
+    None if it was too big to read), or None to drop it"""
+    data = {}
+    if content is None:
+        reason = "size %d" % size
+    else:
+        ftype = filetype.classify_bytes(content[:filetype.SNIFF_SIZE])
+        reason = None
+        if opts.prefilter and not filetype.is_interesting(ftype):
+            reason = "type %s" % ftype
+    if reason is not None:
+        if opts.skipped_files != "record":
+            return None
+        data["FILE"] = "skipped: %s" % reason
+        return data
+
+    try:
+        elf = elf_reader.read_elf(cStringIO.StringIO(content))
+    except elf_reader.ElfError, e:
+        elf = None
+    if elf is None:
+        data["FILE"] = "type %s" % ftype
+        return data
+
+    data.update(elf_reader.elf_tags(elf))
+    return data
+
+def member_data(opts, archive_path, name, content, size):
+    """return the data dict for one archive member, or None to drop it"""
+    tags = member_tags(opts, content, size)
+    if tags is None:
+        return None
+    name = member_path(name)
+    data = {"full_path": archive_path + MEMBER_SEP + name, "basename": os.path.basename(name)}
+    data.update(tags)
+    return data
+
+decorate(traceLog())
+def gather_archive(opts, full_path, ftype, kargs):
+    """return the list of data dicts for an archive and all of its members"""
+    moduleLog.info("Gather archive: %s" % full_path)
+    archive = {"full_path": full_path, "basename": os.path.basename(full_path)}
+    archive.update(kargs)
+    results = [archive]
+    count = 0
+    members = None
+    try:
+        try:
+            package, members = iter_archive(full_path, ftype, opts.max_size)
+            archive.update(package)
+            for name, content, size in members:
+                count = count + 1
+                data = member_data(opts, full_path, name, content, size)
+                if data is None:
+                    continue
+                data.update(kargs)
+                data.pop("STAT", None)
+                data.update(package)
+                results.append(data)
+        finally:
+            if members is not None:
+                members.close()
+    except (ArchiveError, tarfile.TarError, zipfile.BadZipfile, zlib.error, IOError, OSError, EOFError), e:
+        moduleLog.warning("Problem reading archive %s: %s" % (full_path, e))
+        archive["ARCHIVE_ERROR"] = str(e)
+    archive["FILE"] = "archive: %s, %d members" % (ftype, count)
+    return results
@@ -0,0 +1,276 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    In-process reader for the parts of an ELF file that gather cares about:
+    the ELF header (class, byte order, type, machine) and the dynamic section
+    (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH). This lets gather avoid
+    forking 'file' and 'scanelf' for every ELF object it looks at.
+"""
+
+import errno
+import struct
+
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+class ElfError(Exception): pass
+class NotElfError(ElfError): pass
+
+ELF_MAGIC = "\x7fELF"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+SHT_DYNAMIC = 6
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# refuse to believe headers that claim more entries than this
+MAX_TABLE_ENTRIES = 65536
+
+elf_types = {
+    0: "no file type",
+    1: "relocatable",
+    2: "executable",
+    3: "shared object",
+    4: "core file",
+    }
+
+elf_machines = {
+    2: "SPARC",
+    3: "Intel 80386",
+    8: "MIPS",
+    20: "PowerPC",
+    21: "64-bit PowerPC",
+    22: "IBM S/390",
+    40: "ARM",
+    43: "SPARC V9",
+    50: "IA-64",
+    62: "x86-64",
+    183: "ARM aarch64",
+    243: "UCB RISC-V",
+    }
+
+# per-class layouts. Only the fields we use are named, the rest are skipped
+# with pad bytes so that offsets stay correct.
+layouts = {
+    ELFCLASS32: {
+        "ehdr": "HHIIIIIHHHHHH",
+        "phdr": "IIIIIIII",   # type, offset, vaddr, paddr, filesz, memsz, flags, align
+        "shdr": "IIIIIIIIII", # name, type, flags, addr, offset, size, link, info, align, entsize
+        "dyn":  "iI",
+        },
+    ELFCLASS64: {
+        "ehdr": "HHIQQQIHHHHHH",
+        "phdr": "IIQQQQQQ",   # type, flags, offset, vaddr, paddr, filesz, memsz, align
+        "shdr": "IIQQQQIIQQ", # name, type, flags, addr, offset, size, link, info, align, entsize
+        "dyn":  "qQ",
+        },
+    }
+
+# offsets come from the file and may be anything. Seeking past the end is
+# fine (the read comes back short), but an offset that does not fit in an
+# off_t raises OverflowError or ValueError, and one beyond the largest file
+# size the file system allows fails with EINVAL.
+def _seek(fileobj, offset):
+    try:
+        fileobj.seek(offset)
+    except (OverflowError, ValueError), e:
+        raise ElfError("bad offset %d: %s" % (offset, e))
+    except IOError, e:
+        if e.errno != errno.EINVAL:
+            raise
+        raise ElfError("bad offset %d: %s" % (offset, e))
+
+def _unpack(fileobj, fmt, offset):
+    size = struct.calcsize(fmt)
+    _seek(fileobj, offset)
+    buf = fileobj.read(size)
+    if len(buf) != size:
+        raise ElfError("truncated ELF file at offset %d" % offset)
+    return struct.unpack(fmt, buf)
+
+def _read_table(fileobj, fmt, offset, entsize, count):
+    if count > MAX_TABLE_ENTRIES:
+        raise ElfError("unreasonable table size: %d entries" % count)
+    if count and entsize < struct.calcsize(fmt):
+        raise ElfError("table entry size too small: %d" % entsize)
+    return [ _unpack(fileobj, fmt, offset + i * entsize) for i in range(count) ]
+
+def _read_string(fileobj, offset, maxlen=4096):
+    _seek(fileobj, offset)
+    buf = fileobj.read(maxlen)
+    end = buf.find("\0")
+    if end == -1:
+        raise ElfError("unterminated string at offset %d" % offset)
+    return buf[:end]
+
+def _vaddr_to_offset(load_segments, vaddr):
+    for p_offset, p_vaddr, p_filesz in load_segments:
+        if p_vaddr <= vaddr < p_vaddr + p_filesz:
+            return vaddr - p_vaddr + p_offset
+    raise ElfError("address 0x%x is not in any loaded segment" % vaddr)
+
+decorate(traceLog())
+def read_elf(fileobj):
+    """read ELF header and dynamic section from a seekable file object.
+
+    Raises NotElfError if the file is not ELF, ElfError if it is ELF but we
+    cannot make sense of it.
+    """
+    fileobj.seek(0)
+    ident = fileobj.read(16)
+    if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+        raise NotElfError("not an ELF file")
+
+    elf_class = ord(ident[4])
+    elf_data = ord(ident[5])
+    if elf_class not in layouts:
+        raise ElfError("unknown ELF class %d" % elf_class)
+    if elf_data == ELFDATA2LSB:
+        endian = "<"
+    elif elf_data == ELFDATA2MSB:
+        endian = ">"
+    else:
+        raise ElfError("unknown ELF data encoding %d" % elf_data)
+
+    layout = dict([ (k, endian + v) for k, v in layouts[elf_class].items() ])
+    (e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, e_ehsize,
+        e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx) = _unpack(fileobj, layout["ehdr"], 16)
+
+    info = {
+        "elf_class": elf_class == ELFCLASS64 and 64 or 32,
+        "byteorder": elf_data == ELFDATA2LSB and "LSB" or "MSB",
+        "type": elf_types.get(e_type, "unknown type 0x%x" % e_type),
+        "machine": elf_machines.get(e_machine, "machine 0x%x" % e_machine),
+        "version": ord(ident[6]),
+        "interp": None,
+        "dynamic": False,
+        "needed": [],
+        "soname": None,
+        "rpath": None,
+        "runpath": None,
+        }
+
+    # program headers: find loadable segments (for address translation),
+    # the interpreter, and the dynamic segment
+    load_segments = []
+    dynamic_segment = None
+    if e_phoff:
+        for phdr in _read_table(fileobj, layout["phdr"], e_phoff, e_phentsize, e_phnum):
+            if elf_class == ELFCLASS64:
+                p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align = phdr
+            else:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align = phdr
+            if p_type == PT_LOAD:
+                load_segments.append((p_offset, p_vaddr, p_filesz))
+            elif p_type == PT_INTERP:
+                info["interp"] = _read_string(fileobj, p_offset)
+            elif p_type == PT_DYNAMIC:
+                dynamic_segment = (p_offset, p_filesz)
+
+    # prefer the .dynamic section and its linked string table. Fall back to
+    # the dynamic segment for files that have had section headers stripped.
+    dynamic = None
+    strtab_offset = None
+    if e_shoff:
+        sections = _read_table(fileobj, layout["shdr"], e_shoff, e_shentsize, e_shnum)
+        for shdr in sections:
+            sh_type, sh_offset, sh_size, sh_link = shdr[1], shdr[4], shdr[5], shdr[6]
+            if sh_type == SHT_DYNAMIC and sh_link < len(sections):
+                dynamic = (sh_offset, sh_size)
+                strtab_offset = sections[sh_link][4]
+                break
+    if dynamic is None:
+        dynamic = dynamic_segment
+    if dynamic is None:
+        return info
+
+    info["dynamic"] = True
+    dyn_fmt = layout["dyn"]
+    dyn_size = struct.calcsize(dyn_fmt)
+    entries = []
+    for d_tag, d_val in _read_table(fileobj, dyn_fmt, dynamic[0], dyn_size, dynamic[1] // dyn_size):
+        if d_tag == DT_NULL:
+            break
+        entries.append((d_tag, d_val))
+
+    if strtab_offset is None:
+        for d_tag, d_val in entries:
+            if d_tag == DT_STRTAB:
+                strtab_offset = _vaddr_to_offset(load_segments, d_val)
+        if strtab_offset is None:
+            raise ElfError("dynamic section without a string table")
+
+    for d_tag, d_val in entries:
+        if d_tag == DT_NEEDED:
+            info["needed"].append(_read_string(fileobj, strtab_offset + d_val))
+        elif d_tag == DT_SONAME:
+            info["soname"] = _read_string(fileobj, strtab_offset + d_val)
+        elif d_tag == DT_RPATH:
+            info["rpath"] = _read_string(fileobj, strtab_offset + d_val)
+        elif d_tag == DT_RUNPATH:
+            info["runpath"] = _read_string(fileobj, strtab_offset + d_val)
+
+    return info
+
+decorate(traceLog())
+def read_elf_file(path):
+    fileobj = open(path, "rb")
+    try:
+        return read_elf(fileobj)
+    finally:
+        fileobj.close()
+
+decorate(traceLog())
+def read_elf_class(path):
+    """return 32 or 64 for an ELF file, reading only the identification bytes"""
+    fileobj = open(path, "rb")
+    try:
+        ident = fileobj.read(5)
+    finally:
+        fileobj.close()
+    if len(ident) < 5 or ident[:4] != ELF_MAGIC:
+        raise NotElfError("not an ELF file")
+    if ord(ident[4]) == ELFCLASS64:
+        return 64
+    if ord(ident[4]) == ELFCLASS32:
+        return 32
+    raise ElfError("unknown ELF class %d" % ord(ident[4]))
+
+def describe(info):
+    """return a short, file(1)-like description of the ELF object"""
+    desc = "ELF %d-bit %s %s, %s, version %d" % (
+        info["elf_class"], info["byteorder"], info["type"], info["machine"], info["version"])
+    if info["interp"] or info["dynamic"]:
+        desc = desc + ", dynamically linked"
+    else:
+        desc = desc + ", statically linked"
+    if info["interp"]:
+        desc = desc + ", interpreter %s" % info["interp"]
+    return desc
+
+def elf_tags(info):
+    """return the gather data keys for the ELF object"""
+    tags = {"FILE": describe(info), "ELF_CLASS": "ELF%d" % info["elf_class"], "ELF_MACHINE": info["machine"]}
+    if info["needed"]:
+        tags["DT_NEEDED"] = info["needed"]
+    if info["soname"]:
+        tags["SONAME"] = info["soname"]
+    if info["rpath"]:
+        tags["RPATH"] = info["rpath"]
+    if info["runpath"]:
+        tags["RUNPATH"] = info["runpath"]
+    return tags
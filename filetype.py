@@ -0,0 +1,73 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    Cheap file classification by magic bytes. Used by gather to decide which
+    files are worth handing to the (expensive) analysis pipeline.
+"""
+
+import os
+import stat
+
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+# number of bytes we need to look at to classify anything we know about
+SNIFF_SIZE = 512
+
+# (magic, offset, type). First match wins.
+magic_list = [
+    ("\x7fELF",             0, "ELF"),
+    ("MZ",                  0, "PE"),
+    ("PK\x03\x04",          0, "ZIP"),
+    ("PK\x05\x06",          0, "ZIP"),   # empty zip
+    ("!<arch>\n",           0, "AR"),
+    ("\xed\xab\xee\xdb",    0, "RPM"),
+    ("070701",              0, "CPIO"),
+    ("070702",              0, "CPIO"),
+    ("\x1f\x8b",            0, "GZIP"),
+    ("BZh",                 0, "BZIP2"),
+    ("\xfd7zXZ\x00",        0, "XZ"),
+    ("ustar",             257, "TAR"),
+    ("\x89PNG",             0, "PNG"),
+    ("\xff\xd8\xff",        0, "JPEG"),
+    ("GIF8",                0, "GIF"),
+    ("%PDF",                0, "PDF"),
+    ("\xca\xfe\xba\xbe",    0, "JAVA_CLASS"),
+    ("#!",                  0, "SCRIPT"),
+    ]
+
+# types that the analysis pipeline knows how to do something useful with
+INTERESTING_TYPES = ("ELF", "PE", "ZIP", "AR")
+
+decorate(traceLog())
+def classify_bytes(buf):
+    if not buf:
+        return "EMPTY"
+    for magic, offset, filetype in magic_list:
+        if buf[offset:offset+len(magic)] == magic:
+            return filetype
+    if "\0" in buf:
+        return "DATA"
+    return "TEXT"
+
+decorate(traceLog())
+def classify_file(path, st=None):
+    """return the type of the file at path. 'st' is an optional stat result
+    for the path, so callers that already have one dont stat twice."""
+    try:
+        if st is None:
+            st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            return "SPECIAL"
+        fileobj = open(path, "rb")
+        try:
+            return classify_bytes(fileobj.read(SNIFF_SIZE))
+        finally:
+            fileobj.close()
+    except (IOError, OSError), e:
+        moduleLogVerbose.debug("could not classify %s: %s" % (path, e))
+        return "UNREADABLE"
+
+def is_interesting(filetype):
+    return filetype in INTERESTING_TYPES
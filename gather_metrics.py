@@ -0,0 +1,223 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    Counters, latency histograms and queue depth samples for a gather run.
+
+    Every process records into its own Metrics object (get_metrics()).
+    Worker processes hand theirs to the main process with each chunk of
+    results (take() and merge()), and the main process prints a periodic
+    one-line progress summary and writes the totals to a JSON file at the
+    end of the run.
+"""
+
+import os
+import time
+import json
+import threading
+
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+METRICS_VERSION = 1
+
+# upper bounds, in seconds, of the latency histogram buckets. The last
+# bucket takes everything slower.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, 300.0)
+
+def _bucket(seconds):
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(BUCKETS)
+
+def _quantile(buckets, count, q):
+    """upper bound of the bucket holding the q'th quantile"""
+    wanted = q * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen = seen + n
+        if n and seen >= wanted:
+            if i < len(BUCKETS):
+                return BUCKETS[i]
+            return None
+    return None
+
+class Metrics(object):
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.clear()
+
+    def clear(self):
+        # name -> count
+        self.counters = {}
+        # name -> [count, total seconds, max seconds, [bucket counts]]
+        self.timings = {}
+        # name -> [samples, total, max, last, capacity]
+        self.gauges = {}
+
+    def count(self, name, n=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + n
+        finally:
+            self.lock.release()
+
+    def observe(self, name, seconds, n=1):
+        """record one call of stage 'name' that took 'seconds' and handled
+        'n' items"""
+        self.lock.acquire()
+        try:
+            t = self.timings.get(name)
+            if t is None:
+                t = self.timings[name] = [0, 0.0, 0.0, [0] * (len(BUCKETS) + 1), 0]
+            t[0] = t[0] + 1
+            t[1] = t[1] + seconds
+            t[2] = max(t[2], seconds)
+            t[3][_bucket(seconds)] += 1
+            t[4] = t[4] + n
+        finally:
+            self.lock.release()
+
+    def sample(self, name, value, capacity=None):
+        self.lock.acquire()
+        try:
+            g = self.gauges.get(name)
+            if g is None:
+                g = self.gauges[name] = [0, 0, 0, 0, capacity]
+            g[0] = g[0] + 1
+            g[1] = g[1] + value
+            g[2] = max(g[2], value)
+            g[3] = value
+        finally:
+            self.lock.release()
+
+    def take(self):
+        """return everything recorded since the last call and start over.
+        Used by worker processes to ship their numbers to the writer."""
+        self.lock.acquire()
+        try:
+            snapshot = (self.counters, self.timings, self.gauges)
+            self.clear()
+            return snapshot
+        finally:
+            self.lock.release()
+
+    def merge(self, snapshot):
+        counters, timings, gauges = snapshot
+        self.lock.acquire()
+        try:
+            for name, n in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, other in timings.items():
+                t = self.timings.get(name)
+                if t is None:
+                    self.timings[name] = other
+                    continue
+                t[0] = t[0] + other[0]
+                t[1] = t[1] + other[1]
+                t[2] = max(t[2], other[2])
+                t[3] = [ a + b for a, b in zip(t[3], other[3]) ]
+                t[4] = t[4] + other[4]
+            for name, other in gauges.items():
+                g = self.gauges.get(name)
+                if g is None:
+                    self.gauges[name] = other
+                    continue
+                g[0] = g[0] + other[0]
+                g[1] = g[1] + other[1]
+                g[2] = max(g[2], other[2])
+                g[3] = other[3]
+        finally:
+            self.lock.release()
+
+    def progress_line(self, last):
+        """one line summary. 'last' is a dict the caller keeps between calls
+        to work out the current rate."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            written = self.counters.get("files_written", 0)
+            elapsed = now - self.start
+            interval = now - last.get("time", self.start)
+            rate = (written - last.get("written", 0)) / max(interval, 0.001)
+            busiest = sorted([ (t[1], name) for name, t in self.timings.items() ], reverse=True)[:3]
+            queues = [ "%s %d/%s" % (name, g[3], g[4] is None and "-" or g[4]) for name, g in sorted(self.gauges.items()) ]
+        finally:
+            self.lock.release()
+        last["time"] = now
+        last["written"] = written
+        return "Progress: %d files in %ds, %.1f files/s now, %.1f files/s overall; queues: %s; busiest: %s" % (
+            written, elapsed, rate, written / max(elapsed, 0.001), ", ".join(queues) or "-",
+            ", ".join([ "%s %.1fs" % (name, total) for total, name in busiest ]) or "-")
+
+    def report(self, extra=None):
+        """the totals as a dict ready for json"""
+        self.lock.acquire()
+        try:
+            elapsed = time.time() - self.start
+            stages = {}
+            for name, (count, total, maximum, buckets, items) in self.timings.items():
+                stages[name] = {
+                    "calls": count,
+                    "items": items,
+                    "total_s": total,
+                    "mean_s": total / max(count, 1),
+                    "max_s": maximum,
+                    "p50_s": _quantile(buckets, count, 0.5),
+                    "p90_s": _quantile(buckets, count, 0.9),
+                    "p99_s": _quantile(buckets, count, 0.99),
+                    "buckets": [ [ (i < len(BUCKETS) and BUCKETS[i] or None), n ] for i, n in enumerate(buckets) ],
+                    }
+            queues = {}
+            for name, (samples, total, maximum, last, capacity) in self.gauges.items():
+                queues[name] = {"samples": samples, "mean": float(total) / max(samples, 1), "max": maximum, "capacity": capacity}
+            written = self.counters.get("files_written", 0)
+            result = {
+                "version": METRICS_VERSION,
+                "elapsed_s": elapsed,
+                "files_per_s": written / max(elapsed, 0.001),
+                "counters": dict(self.counters),
+                "stages": stages,
+                "queues": queues,
+                }
+        finally:
+            self.lock.release()
+        if extra:
+            result.update(extra)
+        return result
+
+    decorate(traceLog())
+    def write(self, filename, extra=None):
+        tmp = filename + ".tmp"
+        fd = open(tmp, "w")
+        try:
+            json.dump(self.report(extra), fd, indent=2, sort_keys=True)
+            fd.write("\n")
+        finally:
+            fd.close()
+        os.rename(tmp, filename)
+
+# one Metrics object per process. A forked worker starts with an empty one
+# rather than a copy of its parent's.
+_metrics = None
+def get_metrics():
+    global _metrics
+    if _metrics is None or _metrics.pid != os.getpid():
+        _metrics = Metrics()
+    return _metrics
+
+def timed_iter(name, iterable):
+    """yield from iterable, recording the time each step takes as 'name'"""
+    metrics = get_metrics()
+    it = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = it.next()
+        except StopIteration:
+            return
+        metrics.observe(name, time.time() - start)
+        yield item
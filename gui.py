@@ -51,14 +51,20 @@ decorate(traceLog())
 def connect(opts):
     moduleLogVerbose.info("Connecting to db at %s" % opts.dbpath)
     sqlobject.sqlhub.processConnection = sqlobject.connectionForURI('sqlite://%s' % opts.dbpath)
+    # add the columns and tables of a newer gather, as gather and report do
+    license_db.upgradeTables()
 
 class MyTreeModel(gtk.GenericTreeModel):
                     # File, License, Signoff, Comment, STOCK_ID
     _column_types = [str, str, str, str, str ]
     columns = {"basename":0, "license":1, "signoff":2, "comment":3, "compatible":4, "bad_license_list":5}
 
-    def __init__(self, *args, **kargs):
+    def __init__(self, opts, *args, **kargs):
         gtk.GenericTreeModel.__init__(self)
+        self.opts = opts
+        # verdicts come from a snapshot of the dependency graph, see verdict()
+        self.graph = None
+        self.closure = None
         self.fd = license_db.Filedata
 
     def _query_deps(self, row_id):
@@ -112,26 +118,36 @@ class MyTreeModel(gtk.GenericTreeModel):
             return license_db.get_license(filedata)
         elif column == self.columns["signoff"]:
             try:
-                return license_db.tags_matching(filedata, "SIGNOFF").next()
+                return license_db.tag_value(license_db.tags_matching(filedata, "SIGNOFF").next())
             except StopIteration, e:
                 return ""
         elif column == self.columns["comment"]:
             try:
-                return license_db.tags_matching(filedata, "COMMENT").next()
+                return license_db.tag_value(license_db.tags_matching(filedata, "COMMENT").next())
             except StopIteration, e:
                 return ""
         elif column == self.columns["compatible"]:
-            # iter, but will only ever return one record
-            for info in license_db.iter_over_dt_needed(opts, filedata, get_all=False):
-                if info["compatible"]:
-                    return gtk.STOCK_YES
-                elif info["incompat_licenses"]:
-                    return gtk.STOCK_CANCEL
-                return gtk.STOCK_NO
+            compatible, culprits = self.verdict(filedata)
+            if compatible:
+                return gtk.STOCK_YES
+            elif culprits:
+                return gtk.STOCK_CANCEL
+            return gtk.STOCK_NO
         elif column == self.columns["bad_license_list"]:
-            # iter, but will only ever return one record
-            for info in license_db.iter_over_dt_needed(opts, filedata, get_all=False):
-                return info["incompat_licenses"]
+            compatible, culprits = self.verdict(filedata)
+            return culprits
+
+    def verdict(self, filedata):
+        """(compatible, culprit licenses) of a file, as report computes them"""
+        if self.graph is None:
+            self.graph = license_db.GraphSnapshot(matrix=license_db.license_matrix(self.opts))
+        if self.closure is None:
+            self.closure = license_db.LicenseClosure(self.graph)
+        return self.closure.verdict(self.graph.node(filedata.id))
+
+    def licenses_changed(self):
+        """recompute the verdicts after the compatibility list changed"""
+        self.closure = None
 
     decorate(traceLog())
     def on_iter_next(self, rowref):
@@ -209,7 +225,7 @@ class LicenseScanApp(object):
         self.popup    = self.builder.get_object("popup_menu")
 
         # Set up model
-        self.treemodel = MyTreeModel()
+        self.treemodel = MyTreeModel(self.opts)
         self.treeview.set_model(model=self.treemodel)
 
         # actions
@@ -225,9 +241,8 @@ class LicenseScanApp(object):
         path = userdata[0]
         good_lic = userdata[1]
         bad_lic = userdata[2]
-        arr = self.opts.license_compat.get(good_lic, [])
-        arr.append(bad_lic)
-        self.opts.license_compat[good_lic] = arr
+        license_db.add_license_compat(self.opts, good_lic, bad_lic)
+        self.treemodel.licenses_changed()
 
     def _make_menu(self, path, good_lic, licenses, event, time):
         m = gtk.Menu()
@@ -0,0 +1,366 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    Scan container images saved with 'docker save' or as an OCI image layout
+    tarball. Each layer is streamed once and its per-file gather data is
+    cached on disk by layer digest, so base layers shared between images are
+    only analyzed once. The layers are then stacked, honoring whiteouts, and
+    sonames are resolved against the merged filesystem of the image.
+
+    The database links DT_NEEDED entries to libraries by soname. Files in an
+    image are stored with the resolved library's path in place of each
+    soname ("image.tar!/usr/lib/libc.so.6"), so that the stored graph
+    follows the resolution within the image and never reaches libraries
+    of the host or of other images.
+"""
+
+import os
+import json
+import hashlib
+import tarfile
+import cPickle
+
+import archive_scan
+import ld_resolver
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+# bump if the layout of the cached layer data changes
+LAYER_CACHE_VERSION = 1
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+# files whose contents the resolver needs from the image
+content_paths = ("/etc/ld.so.cache",)
+
+decorate(traceLog())
+def is_image(path):
+    """is this tarball a docker-save or OCI image layout?"""
+    try:
+        tf = tarfile.open(path)
+    except (tarfile.TarError, IOError), e:
+        return False
+    try:
+        names = set()
+        for member in tf:
+            names.add(member.name.lstrip("./"))
+            if "manifest.json" in names or ("index.json" in names and "oci-layout" in names):
+                return True
+        return False
+    finally:
+        tf.close()
+
+class HashingReader(object):
+    """file-like wrapper computing the sha256 of everything read through it"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+class LayerCache(object):
+    """on-disk cache of scanned layers, keyed by the layer's diff id"""
+    def __init__(self, cache_dir, opts):
+        self.cache_dir = cache_dir
+        # cached results are only valid for the options that produced them
+        self.header = {"version": LAYER_CACHE_VERSION, "prefilter": opts.prefilter,
+            "skipped_files": opts.skipped_files, "max_size": opts.max_size}
+
+    def path(self, digest):
+        return os.path.join(self.cache_dir, digest.replace(":", "_") + ".layer")
+
+    decorate(traceLog())
+    def load(self, digest):
+        try:
+            fd = open(self.path(digest), "rb")
+        except IOError, e:
+            return None
+        try:
+            try:
+                if cPickle.load(fd) != self.header:
+                    return None
+                return cPickle.load(fd)
+            except (EOFError, cPickle.UnpicklingError, ValueError), e:
+                moduleLogVerbose.info("Ignoring unreadable layer cache for %s: %s" % (digest, e))
+                return None
+        finally:
+            fd.close()
+
+    decorate(traceLog())
+    def save(self, digest, layer):
+        fn = self.path(digest)
+        tmp_fn = "%s.tmp.%d" % (fn, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd = open(tmp_fn, "wb")
+            try:
+                cPickle.dump(self.header, fd, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(layer, fd, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            os.rename(tmp_fn, fn)
+        except (IOError, OSError), e:
+            moduleLog.warning("Could not save layer cache %s: %s" % (fn, e))
+            if os.path.exists(tmp_fn):
+                os.unlink(tmp_fn)
+
+def blob_name(digest):
+    alg, hexdigest = digest.split(":", 1)
+    return "blobs/%s/%s" % (alg, hexdigest)
+
+def _extract(tf, name):
+    try:
+        return tf.extractfile(name)
+    except KeyError, e:
+        return tf.extractfile("./" + name)
+
+def _load_json(tf, name):
+    return json.load(_extract(tf, name))
+
+def _diff_ids(tf, config_name):
+    config = _load_json(tf, config_name)
+    return config.get("rootfs", {}).get("diff_ids", [])
+
+def _oci_images(tf, index, name=None):
+    images = []
+    for desc in index.get("manifests", []):
+        ref = desc.get("annotations", {}).get("org.opencontainers.image.ref.name", name)
+        manifest = _load_json(tf, blob_name(desc["digest"]))
+        if "manifests" in manifest:
+            # an index of per-platform manifests
+            images.extend(_oci_images(tf, manifest, ref))
+            continue
+        diff_ids = _diff_ids(tf, blob_name(manifest["config"]["digest"]))
+        layers = [ blob_name(l["digest"]) for l in manifest.get("layers", []) ]
+        images.append({"name": ref or desc["digest"], "layers": zip(layers, diff_ids + [None] * len(layers))})
+    return images
+
+decorate(traceLog())
+def read_images(tf):
+    """return [{"name": ..., "layers": [(tar member, diff id or None), ...]}]
+    for each image in the tarball, bottom layer first"""
+    names = set([ n.lstrip("./") for n in tf.getnames() ])
+    if "manifest.json" in names:
+        images = []
+        for entry in _load_json(tf, "manifest.json"):
+            diff_ids = _diff_ids(tf, entry["Config"])
+            layers = entry.get("Layers", [])
+            name = (entry.get("RepoTags") or [entry["Config"]])[0]
+            images.append({"name": name, "layers": zip(layers, diff_ids + [None] * len(layers))})
+        return images
+    return _oci_images(tf, _load_json(tf, "index.json"))
+
+decorate(traceLog())
+def scan_layer(opts, fileobj):
+    """stream one layer tarball, returning (layer data, diff id)"""
+    magic = fileobj.read(6)
+    fileobj.seek(0)
+    if magic.startswith("\x1f\x8b"):
+        stream = archive_scan.open_decompressed(fileobj, "gzip")
+    elif magic.startswith("BZh"):
+        stream = archive_scan.open_decompressed(fileobj, "bzip2")
+    elif magic.startswith("\xfd7zXZ") or magic.startswith("\x28\xb5\x2f\xfd"):
+        raise archive_scan.ArchiveError("xz and zstd compressed layers are not supported")
+    else:
+        stream = fileobj
+    stream = HashingReader(stream)
+
+    layer = {"files": {}, "symlinks": {}, "whiteouts": [], "opaque": [], "contents": {}}
+    tf = tarfile.open(fileobj=stream, mode="r|")
+    for member in tf:
+        path = archive_scan.member_path(member.name)
+        dirname, basename = os.path.split(path)
+        if basename == OPAQUE_WHITEOUT:
+            layer["opaque"].append(dirname)
+        elif basename.startswith(WHITEOUT_PREFIX):
+            layer["whiteouts"].append(os.path.join(dirname, basename[len(WHITEOUT_PREFIX):]))
+        elif member.issym():
+            layer["symlinks"][path] = member.linkname
+        elif member.islnk():
+            target = archive_scan.member_path(member.linkname)
+            if target in layer["files"]:
+                layer["files"][path] = layer["files"][target]
+        elif member.isfile():
+            content = None
+            if member.size <= archive_scan.member_max_size(opts.max_size):
+                content = tf.extractfile(member).read()
+            if path in content_paths:
+                layer["contents"][path] = content
+            layer["files"][path] = archive_scan.member_tags(opts, content, member.size)
+    # the diff id covers the whole uncompressed stream, including padding
+    while stream.read(1024 * 1024):
+        pass
+    return (layer, "sha256:" + stream.hexdigest())
+
+class MergedView(object):
+    """the filesystem of an image: its layers stacked bottom to top"""
+    def __init__(self):
+        self.files = {}     # path -> (tags, layer digest)
+        self.symlinks = {}  # path -> target
+        self.contents = {}  # path -> file contents, for content_paths
+
+    def hidden(self, path, removed, opaque):
+        if path in removed:
+            return True
+        parent = os.path.dirname(path)
+        while True:
+            if parent in removed or parent in opaque:
+                return True
+            if parent == "/":
+                return False
+            parent = os.path.dirname(parent)
+
+    decorate(traceLog())
+    def apply(self, digest, layer):
+        # whiteouts only hide what the lower layers put there
+        removed = set(layer["whiteouts"])
+        opaque = set(layer["opaque"])
+        if removed or opaque:
+            for table in (self.files, self.symlinks, self.contents):
+                for path in table.keys():
+                    if self.hidden(path, removed, opaque):
+                        del table[path]
+        for path, tags in layer["files"].items():
+            self.files[path] = (tags, digest)
+            self.symlinks.pop(path, None)
+            self.contents.pop(path, None)
+        for path, target in layer["symlinks"].items():
+            self.symlinks[path] = target
+            self.files.pop(path, None)
+            self.contents.pop(path, None)
+        self.contents.update(layer["contents"])
+
+    def realpath(self, path):
+        """resolve symlinks in path within the image, or None for a loop"""
+        hops = 0
+        parts = [ p for p in path.split("/") if p ]
+        resolved = ""
+        while parts:
+            current = resolved + "/" + parts.pop(0)
+            target = self.symlinks.get(current)
+            if target is None:
+                resolved = current
+                continue
+            hops = hops + 1
+            if hops > 40:
+                return None
+            if not target.startswith("/"):
+                target = (resolved or "/") + "/" + target
+            parts = [ p for p in os.path.normpath(target).split("/") if p ] + parts
+            resolved = ""
+        return resolved or "/"
+
+class ImageResolver(ld_resolver.Resolver):
+    """dynamic linker resolution against a MergedView instead of the host"""
+    def __init__(self, view):
+        self.view = view
+        ld_resolver.Resolver.__init__(self)
+
+    def load_cache(self, cache_fn):
+        buf = self.view.contents.get(self.view.realpath(cache_fn))
+        if buf:
+            self.add_cache(buf)
+
+    def elf_class(self, path):
+        real = self.view.realpath(path)
+        entry = self.view.files.get(real)
+        if entry is None or not entry[0]:
+            return False
+        return {"ELF32": 32, "ELF64": 64}.get(entry[0].get("ELF_CLASS"), False)
+
+decorate(traceLog())
+def image_data(opts, prefix, view, kargs):
+    """return the data dicts for every file in the merged view"""
+    resolver = ImageResolver(view)
+    scoped = lambda path: prefix + archive_scan.MEMBER_SEP + path
+    needed = {}
+    unresolved = {}
+    libs = set()
+    for path, (tags, digest) in view.files.items():
+        if not tags: continue
+        elf_class = {"ELF32": 32, "ELF64": 64}.get(tags.get("ELF_CLASS"))
+        for soname in tags.get("DT_NEEDED", []):
+            lib = resolver.resolve(soname, path, tags.get("RPATH"), tags.get("RUNPATH"), elf_class)
+            if lib is not None:
+                lib = view.realpath(lib)
+            if lib is None:
+                unresolved.setdefault(path, []).append(soname)
+                needed.setdefault(path, []).append(scoped(soname))
+            else:
+                libs.add(lib)
+                needed.setdefault(path, []).append(scoped(lib))
+
+    results = []
+    for path, (tags, digest) in view.files.items():
+        if tags is None: continue
+        data = {"full_path": scoped(path), "basename": os.path.basename(path), "LAYER": digest}
+        data.update(kargs)
+        data.pop("STAT", None)
+        data.update(tags)
+        # the names from the ELF file are kept as tags
+        if "DT_NEEDED" in data:
+            data["DT_NEEDED_NAMES"] = ",".join(data.pop("DT_NEEDED"))
+        if "SONAME" in data:
+            data["DT_SONAME"] = data.pop("SONAME")
+        if path in needed:
+            data["DT_NEEDED"] = needed[path]
+        if path in libs:
+            data["SONAME"] = scoped(path)
+        if path in unresolved:
+            data["UNRESOLVED_SONAME"] = ",".join(unresolved[path])
+        results.append(data)
+    return results
+
+decorate(traceLog())
+def gather_image(opts, full_path, kargs):
+    """return the list of data dicts for an image tarball and its files"""
+    moduleLog.info("Gather image: %s" % full_path)
+    image = {"full_path": full_path, "basename": os.path.basename(full_path)}
+    image.update(kargs)
+    results = [image]
+    cache = None
+    if opts.layer_cache:
+        cache = LayerCache(opts.layer_cache, opts)
+    images = []
+    scanned = 0
+    try:
+        tf = tarfile.open(full_path)
+        try:
+            images = read_images(tf)
+            for entry in images:
+                prefix = full_path
+                if len(images) > 1:
+                    prefix = full_path + archive_scan.MEMBER_SEP + entry["name"]
+                view = MergedView()
+                for member, digest in entry["layers"]:
+                    layer = None
+                    if digest and cache is not None:
+                        layer = cache.load(digest)
+                    if layer is None:
+                        moduleLogVerbose.info("Scanning layer %s" % (digest or member))
+                        layer, stream_digest = scan_layer(opts, _extract(tf, member))
+                        digest = digest or stream_digest
+                        scanned = scanned + 1
+                        if cache is not None:
+                            cache.save(digest, layer)
+                    else:
+                        moduleLogVerbose.info("Using cached layer %s" % digest)
+                    view.apply(digest, layer)
+                results.extend(image_data(opts, prefix, view, kargs))
+        finally:
+            tf.close()
+    except (archive_scan.ArchiveError, tarfile.TarError, KeyError, ValueError, IOError, OSError, EOFError), e:
+        moduleLog.warning("Problem reading image %s: %s" % (full_path, e))
+        image["ARCHIVE_ERROR"] = str(e)
+    moduleLogVerbose.info("Image %s: %d layers scanned" % (full_path, scanned))
+    image["FILE"] = "container image: %d images" % len(images)
+    return results
@@ -0,0 +1,168 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    Resolve DT_NEEDED sonames to file paths the way the dynamic linker does:
+    DT_RPATH (when there is no DT_RUNPATH), DT_RUNPATH, /etc/ld.so.cache and
+    finally the default library directories, with $ORIGIN and $LIB expanded.
+    Everything is done in-process and memoized, and an optional sysroot lets
+    the same logic run against a cross or unpacked tree.
+"""
+
+import os
+import struct
+
+import elf_reader
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+OLD_CACHE_MAGIC = "ld.so-1.7.0"
+NEW_CACHE_MAGIC = "glibc-ld.so.cache1.1"
+
+# search order for the trusted directories, after the cache
+default_dirs = {
+    32: ["/lib", "/usr/lib", "/lib32", "/usr/lib32"],
+    64: ["/lib64", "/usr/lib64", "/lib", "/usr/lib"],
+    None: ["/lib64", "/usr/lib64", "/lib", "/usr/lib"],
+    }
+
+def _cstring(buf, offset):
+    end = buf.find("\0", offset)
+    if end == -1:
+        return None
+    return buf[offset:end]
+
+decorate(traceLog())
+def parse_ld_so_cache(buf):
+    """return the list of (soname, path) entries in an ld.so.cache image, in
+    cache order (which is the order the dynamic linker prefers them)"""
+    new_offset = None
+    entries = []
+    if buf.startswith(OLD_CACHE_MAGIC):
+        (nlibs,) = struct.unpack_from("=I", buf, 12)
+        strtab = 16 + nlibs * 12
+        if buf[strtab:strtab+len(NEW_CACHE_MAGIC)] != NEW_CACHE_MAGIC:
+            # the new format, when present, follows the old entries aligned to 8 bytes
+            aligned = (strtab + 7) & ~7
+            if buf[aligned:aligned+len(NEW_CACHE_MAGIC)] == NEW_CACHE_MAGIC:
+                strtab = aligned
+        if buf[strtab:strtab+len(NEW_CACHE_MAGIC)] == NEW_CACHE_MAGIC:
+            new_offset = strtab
+        else:
+            for i in range(nlibs):
+                flags, key, value = struct.unpack_from("=iII", buf, 16 + i * 12)
+                entries.append((_cstring(buf, strtab + key), _cstring(buf, strtab + value)))
+    elif buf.startswith(NEW_CACHE_MAGIC):
+        new_offset = 0
+
+    if new_offset is not None:
+        endian = "="
+        flags = ord(buf[new_offset + 28])
+        if flags & 3 == 2:
+            endian = "<"
+        elif flags & 3 == 3:
+            endian = ">"
+        (nlibs,) = struct.unpack_from(endian + "I", buf, new_offset + 20)
+        for i in range(nlibs):
+            flags, key, value = struct.unpack_from(endian + "iII", buf, new_offset + 48 + i * 24)
+            # string offsets are relative to the start of the new header
+            entries.append((_cstring(buf, new_offset + key), _cstring(buf, new_offset + value)))
+
+    return [ (k, v) for k, v in entries if k and v ]
+
+class Resolver(object):
+    def __init__(self, sysroot=None, cache_fn="/etc/ld.so.cache"):
+        self.sysroot = sysroot or ""
+        self.cache = {}
+        self.memo = {}
+        self.class_memo = {}
+        self.load_cache(self.host_path(cache_fn))
+
+    def host_path(self, path):
+        if self.sysroot and path.startswith("/"):
+            return os.path.join(self.sysroot, path.lstrip("/"))
+        return path
+
+    decorate(traceLog())
+    def load_cache(self, cache_fn):
+        try:
+            fd = open(cache_fn, "rb")
+            try:
+                buf = fd.read()
+            finally:
+                fd.close()
+        except IOError, e:
+            moduleLogVerbose.info("No dynamic linker cache at %s" % cache_fn)
+            return
+        self.add_cache(buf)
+        moduleLogVerbose.info("Loaded %d sonames from %s" % (len(self.cache), cache_fn))
+
+    def add_cache(self, buf):
+        for soname, path in parse_ld_so_cache(buf):
+            self.cache.setdefault(soname, []).append(path)
+
+    def elf_class(self, host_path):
+        if host_path not in self.class_memo:
+            try:
+                self.class_memo[host_path] = elf_reader.read_elf_class(host_path)
+            except (elf_reader.ElfError, IOError, OSError), e:
+                self.class_memo[host_path] = False
+        return self.class_memo[host_path]
+
+    def usable(self, host_path, elf_class):
+        """is the file there, and is it a library of the right ELF class?"""
+        found = self.elf_class(host_path)
+        if not found:
+            return False
+        return elf_class is None or found == elf_class
+
+    def expand(self, entry, origin, elf_class):
+        lib = elf_class == 32 and "lib" or "lib64"
+        for var, value in (("$ORIGIN", origin), ("${ORIGIN}", origin), ("$LIB", lib), ("${LIB}", lib)):
+            if var in entry:
+                if value is None:
+                    return None
+                entry = entry.replace(var, value)
+        return entry
+
+    def search_path(self, requester, rpath, runpath, elf_class):
+        """the list of directories to search, as host paths"""
+        origin = None
+        if requester is not None:
+            origin = os.path.dirname(requester)
+        dirs = []
+        # DT_RPATH is ignored when DT_RUNPATH is present
+        for entries in (not runpath and rpath or None, runpath):
+            if not entries: continue
+            for entry in entries.split(":"):
+                if not entry: continue
+                expanded = self.expand(entry, origin, elf_class)
+                if expanded is None: continue
+                if "$ORIGIN" not in entry and "${ORIGIN}" not in entry:
+                    expanded = self.host_path(expanded)
+                dirs.append(expanded)
+        return tuple(dirs)
+
+    decorate(traceLog())
+    def resolve(self, soname, requester=None, rpath=None, runpath=None, elf_class=None):
+        """return the host path that 'soname' resolves to for a file at
+        'requester' with the given DT_RPATH/DT_RUNPATH and ELF class, or None"""
+        dirs = self.search_path(requester, rpath, runpath, elf_class)
+        key = (dirs, soname, elf_class)
+        if key in self.memo:
+            return self.memo[key]
+
+        result = None
+        if "/" in soname:
+            candidates = [ self.host_path(soname) ]
+        else:
+            candidates = [ os.path.join(d, soname) for d in dirs ]
+            candidates.extend([ self.host_path(p) for p in self.cache.get(soname, []) ])
+            candidates.extend([ self.host_path(os.path.join(d, soname)) for d in default_dirs.get(elf_class, default_dirs[None]) ])
+        for candidate in candidates:
+            if self.usable(candidate, elf_class):
+                result = candidate
+                break
+
+        self.memo[key] = result
+        return result
@@ -1,8 +1,17 @@
 import sqlobject
 import os
+import array
+import zlib
+import hashlib
 import inspect
 from trace_decorator import decorate, traceLog, getLog
 
+# numpy is optional: batch_verdicts() falls back to plain Python without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 moduleLog = getLog()
 moduleLogVerbose = getLog(prefix="verbose.")
 
@@ -12,6 +21,8 @@ def connect(opts):
     sqlobject.sqlhub.processConnection = sqlobject.connectionForURI(opts.dbconnstr)
 
     for clas in iterTables():
+        # tables added after the first release are created by upgradeTables()
+        if clas in added_tables: continue
         if not clas.tableExists():
             moduleLogVerbose.info("Some required tables do not exist. Forcing database initialization.")
             opts.initdb = True
@@ -19,7 +30,56 @@ def connect(opts):
 
     if opts.initdb:
         dropTables()
-        createTables()
+        # a bulk load into a new database creates the indexes once it is
+        # done, see BulkWriter.create_indexes()
+        createTables(createIndexes=getattr(opts, "storage_profile", "default") != "bulk")
+    else:
+        upgradeTables()
+
+# SQLite settings for each storage profile. 'default' leaves SQLite alone.
+# 'bulk' is for loading: WAL journaling, so that report and the GUI can
+# read the database while gather writes to it, syncing at checkpoints only,
+# a 256MB page cache, a 1GB memory map and temporary tables in memory.
+storage_profiles = {
+    "default": (),
+    "bulk": (
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("cache_size", "-262144"),
+        ("mmap_size", "1073741824"),
+        ("temp_store", "MEMORY"),
+        ),
+    }
+
+decorate(traceLog())
+def apply_profile(trans, profile):
+    """set the pragmas of a storage profile on the connection of trans.
+    Must be called before the transaction writes anything."""
+    if trans._dbConnection.dbName != "sqlite":
+        return
+    cursor = trans._connection.cursor()
+    for name, value in storage_profiles[profile]:
+        moduleLogVerbose.debug("PRAGMA %s = %s" % (name, value))
+        cursor.execute("PRAGMA %s = %s" % (name, value))
+
+# Values of the tool output tags longer than this are stored once in the
+# blob table, compressed and keyed by their hash, and the tag holds a
+# reference to the blob instead of the text. Read tags with tag_value().
+BLOB_TAGS = ("NM", "NM_D", "OBJDUMP")
+BLOB_THRESHOLD = 1024
+BLOB_PREFIX = "blob:sha1:"
+
+def blob_digest(value):
+    return hashlib.sha1(value).hexdigest()
+
+def tag_value(tag):
+    """the full text of a tag, fetching it from the blob table if needed"""
+    if tag.tagname in BLOB_TAGS and tag.tagvalue.startswith(BLOB_PREFIX):
+        # raw query: the BLOBCol converters re-encode the data for sqlite
+        conn = tag._connection
+        row = conn.queryOne("SELECT data FROM blob WHERE digest = %s" % conn.sqlrepr(tag.tagvalue[len(BLOB_PREFIX):]))
+        return zlib.decompress(str(row[0]))
+    return tag.tagvalue
 
 decorate(traceLog())
 def tags_matching(fileobj, tagname):
@@ -33,9 +93,25 @@ def tags_matching_any(fileobj, taglist):
         if t.tagname in taglist:
             yield t
 
+# license types in the order get_license() prefers them by default
+preferred_license_types = ("MANUAL", "RPM")
+
+# effective licenses worked out on the fly, by (table, id, preference).
+# Cleared by resolve_licenses().
+_license_memo = {}
+
 decorate(traceLog())
 def get_license(filedata, preferred=None):
-    if preferred is None: preferred = ["MANUAL", "RPM" ]
+    # resolve_licenses() stores the answer for the default preference
+    if preferred is None and filedata.resolved_license is not None:
+        return filedata.resolved_license
+    if preferred is None: preferred = preferred_license_types
+    key = ("filedata", filedata.id, tuple(preferred))
+    if key not in _license_memo:
+        _license_memo[key] = _pick_license(filedata, preferred)
+    return _license_memo[key]
+
+def _pick_license(filedata, preferred):
     for pref in preferred:
         for l in filedata.license:
             if l.license_type == pref:
@@ -48,6 +124,14 @@ def get_license(filedata, preferred=None):
 
 decorate(traceLog())
 def get_license_soname(soname, preferred=None):
+    if preferred is None and soname.resolved_license is not None:
+        return soname.resolved_license
+    key = ("soname", soname.id, tuple(preferred or preferred_license_types))
+    if key not in _license_memo:
+        _license_memo[key] = _pick_license_soname(soname, preferred)
+    return _license_memo[key]
+
+def _pick_license_soname(soname, preferred):
     # try checking things with actual SONAME first
     for fd in soname.needed_by:
         lic = get_license(fd, preferred)
@@ -64,13 +148,91 @@ def get_license_soname(soname, preferred=None):
 
     return "NOT_FOUND_LIB"
 
+# Store what get_license() and get_license_soname() return for the default
+# preference in filedata.resolved_license and soname.resolved_license, so
+# that readers get it without looking at the license rows. Run at the end of
+# every load; files added since the last run have NULL there and fall back
+# to working it out on the fly.
+decorate(traceLog())
+def resolve_licenses(connection=None):
+    if connection is None:
+        connection = sqlobject.sqlhub.processConnection
+    rank = " ".join([ "WHEN '%s' THEN %d" % (t, i) for i, t in enumerate(preferred_license_types) ])
+    connection.query("""UPDATE filedata SET resolved_license = COALESCE(
+        (SELECT l.license FROM filedata_license fl JOIN license l ON l.id = fl.license_id
+            WHERE fl.filedata_id = filedata.id
+            ORDER BY CASE l.license_type %s ELSE %d END, fl.id LIMIT 1),
+        'NOT_FOUND_FD')""" % (rank, len(preferred_license_types)))
+    connection.query("""UPDATE soname SET resolved_license = COALESCE(
+        (SELECT f.resolved_license FROM dt_needed_list d JOIN filedata f ON f.id = d.filedata_id
+            WHERE d.soname_id = soname.id AND f.resolved_license <> 'NOT_FOUND_FD'
+            ORDER BY d.id LIMIT 1),
+        (SELECT f.resolved_license FROM filedata f
+            WHERE f.basename = soname.soname AND f.resolved_license <> 'NOT_FOUND_FD'
+            ORDER BY f.id LIMIT 1),
+        'NOT_FOUND_LIB')""")
+    _license_memo.clear()
+
 decorate(traceLog())
 def license_is_compatible(opts, lic1, lic2):
-    if lic1 == lic2:
-        return True
-    if lic2 in opts.license_compat.get(lic1, []):
-        return True
-    return False
+    matrix = license_matrix(opts)
+    return matrix.compatible(matrix.intern(lic1), matrix.intern(lic2))
+
+# The license compatibility list compiled to bitsets. Licenses are interned
+# to small integers, and bits[i] has bit j set when license i may use
+# license j (every license may use itself). A check is a single bit test,
+# and a set of licenses held as a bitset is checked in one operation.
+class LicenseMatrix(object):
+    def __init__(self, license_compat=None):
+        self.names = []
+        self.ids = {}
+        self.bits = []
+        for license, compat_licenses in sorted((license_compat or {}).items()):
+            for other in compat_licenses:
+                self.allow(license, other)
+
+    def intern(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.bits.append(1 << id)
+        return id
+
+    def allow(self, license, other):
+        id = self.intern(license)
+        self.bits[id] = self.bits[id] | (1 << self.intern(other))
+
+    def compatible(self, lic1, lic2):
+        return (self.bits[lic1] >> lic2) & 1 == 1
+
+    def incompatible(self, lic, licenses):
+        """the licenses in the bitset 'licenses' that lic may not use"""
+        return licenses & ~self.bits[lic]
+
+    def names_of(self, licenses):
+        """sorted names of the licenses in a bitset"""
+        names = []
+        id = 0
+        while licenses:
+            if licenses & 1:
+                names.append(self.names[id])
+            licenses = licenses >> 1
+            id = id + 1
+        names.sort()
+        return names
+
+# the compiled form of opts.license_compat, built on first use
+def license_matrix(opts):
+    matrix = getattr(opts, "license_matrix", None)
+    if matrix is None:
+        matrix = opts.license_matrix = LicenseMatrix(opts.license_compat)
+    return matrix
+
+# record that 'license' may use 'other', keeping the compiled form current
+def add_license_compat(opts, license, other):
+    opts.license_compat.setdefault(license, []).append(other)
+    license_matrix(opts).allow(license, other)
 
 def iter_over_dt_needed_nonrecursive(opts, filedata, parent=None):
     from license_db import DtNeededList
@@ -147,6 +309,727 @@ def iter_over_dt_needed(opts, filedata, parent=None, myfault=0, get_all=True, br
     yield inforec
 
 
+# Read-only copy of the dependency graph for reports, loaded with a few bulk
+# queries instead of the per-node ORM queries of iter_over_dt_needed().
+# Nodes are numbered 0..n-1 in filedata id order. The libraries satisfying
+# the DT_NEEDED entries of node i are
+#     edge_targets[edge_start[i]:edge_start[i+1]]
+# Basenames are interned in a string table and licenses in a LicenseMatrix
+# (pass license_matrix(opts) to check them against the compatibility list),
+# so each node is just a few integers.
+class GraphSnapshot(object):
+    def __init__(self, connection=None, preferred=None, matrix=None):
+        if connection is None:
+            connection = sqlobject.sqlhub.processConnection
+        if preferred is None:
+            preferred = preferred_license_types
+        if matrix is None:
+            matrix = LicenseMatrix()
+        self.matrix = matrix
+        self.strings = []
+        self.string_ids = {}
+
+        self.ids = array.array("l")
+        self.index = {}
+        self.basenames = array.array("l")
+        # the license get_license() would pick for each node, taken from
+        # resolve_licenses() when every file has one
+        self.licenses = array.array("l")
+        resolved = tuple(preferred) == preferred_license_types
+        # assume an up to date schema where the columns cannot be listed
+        if "resolved_license" in (table_columns(connection, "filedata") or ["resolved_license"]):
+            rows = connection.queryAll("SELECT id, basename, resolved_license FROM filedata ORDER BY id")
+        else:
+            # a database not upgraded since the column was added
+            rows = [ row + (None,) for row in connection.queryAll("SELECT id, basename FROM filedata ORDER BY id") ]
+        for id, basename, license in rows:
+            self.index[id] = len(self.ids)
+            self.ids.append(id)
+            self.basenames.append(self.intern(basename))
+            if license is None:
+                resolved = False
+                license = "NOT_FOUND_FD"
+            self.licenses.append(matrix.intern(license))
+
+        if not resolved:
+            self.licenses = array.array("l", [matrix.intern("NOT_FOUND_FD")]) * len(self.ids)
+            rank = {}
+            for filedata_id, license, license_type in connection.queryAll(
+                    "SELECT fl.filedata_id, l.license, l.license_type FROM filedata_license fl"
+                    " JOIN license l ON l.id = fl.license_id ORDER BY fl.id"):
+                node = self.index.get(filedata_id)
+                if node is None: continue
+                if license_type in preferred:
+                    r = list(preferred).index(license_type)
+                else:
+                    r = len(preferred)
+                if r < rank.get(node, len(preferred) + 1):
+                    rank[node] = r
+                    self.licenses[node] = matrix.intern(license)
+
+        self.has_needed = array.array("b", [0]) * len(self.ids)
+        for (filedata_id,) in connection.queryAll("SELECT DISTINCT filedata_id FROM dt_needed_list"):
+            if filedata_id in self.index:
+                self.has_needed[self.index[filedata_id]] = 1
+
+        edges = [ (self.index[source], self.index[target]) for source, target in connection.queryAll(
+                "SELECT d.filedata_id, s.filedata_id FROM dt_needed_list d"
+                " JOIN soname_list s ON s.soname_id = d.soname_id ORDER BY d.filedata_id, d.id, s.id")
+            if source in self.index and target in self.index ]
+        # edges arrive grouped by source in id order, which is node order
+        self.edge_start = array.array("l", [0]) * (len(self.ids) + 1)
+        self.edge_targets = array.array("l", [ target for source, target in edges ])
+        for source, target in edges:
+            self.edge_start[source + 1] += 1
+        for i in range(len(self.ids)):
+            self.edge_start[i + 1] += self.edge_start[i]
+
+    def intern(self, s):
+        id = self.string_ids.get(s)
+        if id is None:
+            id = self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return id
+
+    def __len__(self):
+        return len(self.ids)
+
+    def node(self, filedata_id):
+        return self.index.get(filedata_id)
+
+    def filedata_id(self, node):
+        return self.ids[node]
+
+    def basename(self, node):
+        return self.strings[self.basenames[node]]
+
+    def license(self, node):
+        return self.matrix.names[self.licenses[node]]
+
+    def children(self, node):
+        return self.edge_targets[self.edge_start[node]:self.edge_start[node + 1]]
+
+    def roots(self):
+        """the nodes with DT_NEEDED entries, sorted by basename"""
+        nodes = [ i for i in range(len(self.ids)) if self.has_needed[i] ]
+        nodes.sort(key=self.basename)
+        return nodes
+
+    def components(self):
+        """strongly connected components (Tarjan, without recursion).
+        Returns (component number of each node, list of the nodes of each
+        component). Components are numbered dependencies first: every edge
+        leads to the same or a lower numbered component."""
+        n = len(self.ids)
+        index = array.array("l", [-1]) * n
+        low = array.array("l", [0]) * n
+        on_stack = array.array("b", [0]) * n
+        component = array.array("l", [-1]) * n
+        members = []
+        stack = []
+        counter = 0
+        for root in range(n):
+            if index[root] != -1: continue
+            index[root] = low[root] = counter
+            counter = counter + 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [[root, self.edge_start[root]]]
+            while work:
+                frame = work[-1]
+                node = frame[0]
+                if frame[1] < self.edge_start[node + 1]:
+                    child = self.edge_targets[frame[1]]
+                    frame[1] = frame[1] + 1
+                    if index[child] == -1:
+                        index[child] = low[child] = counter
+                        counter = counter + 1
+                        stack.append(child)
+                        on_stack[child] = 1
+                        work.append([child, self.edge_start[child]])
+                    elif on_stack[child] and index[child] < low[node]:
+                        low[node] = index[child]
+                    continue
+                work.pop()
+                if work and low[node] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[node]
+                if low[node] == index[node]:
+                    nodes = []
+                    while True:
+                        m = stack.pop()
+                        on_stack[m] = 0
+                        component[m] = len(members)
+                        nodes.append(m)
+                        if m == node: break
+                    members.append(nodes)
+        return component, members
+
+# Transitive license check over a GraphSnapshot. The graph is condensed into
+# strongly connected components, and for each component the set of licenses
+# reachable below it is computed once, dependencies first, so the whole
+# closure costs one pass over the edges however many executables share a
+# library. A file is compatible when its license is compatible with every
+# license below it and every file below it is compatible in the same way;
+# the culprits are the licenses below it that its own license is not
+# compatible with. Files in a dependency cycle are below each other.
+# License sets are bitsets over the graph's LicenseMatrix, so checking a
+# file against everything below it is one AND.
+class LicenseClosure(object):
+    def __init__(self, graph):
+        self.graph = graph
+        self.matrix = matrix = graph.matrix
+        self.component, self.members = graph.components()
+        licenses = graph.licenses
+        # per component: bitset of the licenses reachable below it, and
+        # whether anything in or below it is incompatible
+        self.below = []
+        self.bad = array.array("b")
+        for c, nodes in enumerate(self.members):
+            below = 0
+            bad = False
+            cyclic = len(nodes) > 1
+            for node in nodes:
+                for child in graph.children(node):
+                    d = self.component[child]
+                    if d == c:
+                        cyclic = True
+                        continue
+                    below = below | (1 << licenses[child]) | self.below[d]
+                    bad = bad or self.bad[d]
+            if cyclic:
+                for node in nodes:
+                    below = below | (1 << licenses[node])
+            if not bad:
+                for node in nodes:
+                    if matrix.incompatible(licenses[node], below):
+                        bad = True
+                        break
+            self.below.append(below)
+            self.bad.append(bad)
+
+    def is_compatible(self, node):
+        return not self.bad[self.component[node]]
+
+    def verdict(self, node):
+        """(compatible, sorted culprit license names) for a node"""
+        culprits = self.matrix.incompatible(self.graph.licenses[node], self.below[self.component[node]])
+        return (self.is_compatible(node), self.matrix.names_of(culprits))
+
+    def iter_tree(self, node, max_level=32):
+        """the dependency tree of node for printing, as iter_over_dt_needed()
+        records (children before their parent) with the node number under
+        "node". Within one tree each file is expanded once and levels stop
+        at max_level. "compatible" is the file's verdict, "culprit" is set
+        when a file above it on this path is incompatible with its license."""
+        graph = self.graph
+        bits = self.matrix.bits
+        seen = set()
+        # licenses every file on the current path may use
+        allowed = [-1]
+        def walk(node, level):
+            lic = graph.licenses[node]
+            culprit = not (allowed[-1] >> lic) & 1
+            expand = node not in seen and level < max_level
+            seen.add(node)
+            if expand:
+                allowed.append(allowed[-1] & bits[lic])
+                for child in graph.children(node):
+                    for rec in walk(child, level + 1):
+                        yield rec
+                allowed.pop()
+            yield { "level": level, "culprit": culprit, "compatible": self.is_compatible(node), "node": node }
+        return walk(node, 0)
+
+decorate(traceLog())
+def batch_verdicts(graph, nodes=None, use_numpy=None):
+    """the LicenseClosure verdicts of many files at once (default: every
+    file with DT_NEEDED entries), as a list of (filedata id, compatible,
+    incompatible license ids) in the order of 'nodes'. License ids index
+    graph.matrix.names. Uses numpy when it is available."""
+    if nodes is None:
+        nodes = graph.roots()
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        return _batch_verdicts_numpy(graph, nodes)
+    closure = LicenseClosure(graph)
+    result = []
+    for node in nodes:
+        incompatible = graph.matrix.incompatible(graph.licenses[node], closure.below[closure.component[node]])
+        result.append((graph.ids[node], closure.is_compatible(node), _bit_ids(incompatible)))
+    return result
+
+def _bit_ids(bits):
+    ids = []
+    id = 0
+    while bits:
+        if bits & 1:
+            ids.append(id)
+        bits = bits >> 1
+        id = id + 1
+    return ids
+
+# LicenseClosure with every license set held as a row of 64 bit words, so
+# that each step below is a handful of array operations over all edges or
+# all files rather than a Python loop. Components are grouped by their
+# height in the condensed graph; a component only depends on lower ones, so
+# one level at a time the sets are propagated upwards with a scattered OR.
+def _batch_verdicts_numpy(graph, nodes):
+    matrix = graph.matrix
+    words = max(1, (len(matrix.names) + 63) // 64)
+    def bit_rows(values):
+        rows = numpy.zeros((len(values), words), dtype=numpy.uint64)
+        for i, value in enumerate(values):
+            for w in range(words):
+                rows[i, w] = (value >> (64 * w)) & 0xffffffffffffffff
+        return rows
+
+    component, members = graph.components()
+    component = numpy.array(component, dtype=numpy.intp)
+    licenses = numpy.array(graph.licenses, dtype=numpy.intp)
+    targets = numpy.array(graph.edge_targets, dtype=numpy.intp)
+    sources = numpy.repeat(numpy.arange(len(graph.ids)), numpy.diff(numpy.array(graph.edge_start, dtype=numpy.intp)))
+    n_components = len(members)
+
+    # one bit per file for its own license, and the compatibility rows
+    license_word = licenses // 64
+    license_bit = numpy.left_shift(numpy.uint64(1), (licenses % 64).astype(numpy.uint64))
+    own = numpy.zeros((len(licenses), words), dtype=numpy.uint64)
+    own[numpy.arange(len(licenses)), license_word] = license_bit
+    compat = bit_rows(matrix.bits)
+
+    src = component[sources]
+    dst = component[targets]
+    internal = src == dst
+    below = numpy.zeros((n_components, words), dtype=numpy.uint64)
+    # members of a cycle are below each other
+    cyclic = numpy.bincount(component, minlength=n_components) > 1
+    cyclic[src[internal]] = True
+    in_cycle = cyclic[component]
+    numpy.bitwise_or.at(below, component[in_cycle], own[in_cycle])
+
+    src = src[~internal]
+    dst = dst[~internal]
+    child = targets[~internal]
+    height = numpy.zeros(n_components, dtype=numpy.intp)
+    while len(src):
+        new_height = height.copy()
+        numpy.maximum.at(new_height, src, height[dst] + 1)
+        if (new_height == height).all():
+            break
+        height = new_height
+
+    # files whose license is incompatible with something below them, and
+    # through them their component and everything above it
+    bad = numpy.zeros(n_components, dtype=bool)
+    levels = numpy.unique(height[src])
+    for level in levels:
+        edges = height[src] == level
+        numpy.bitwise_or.at(below, src[edges], own[child[edges]] | below[dst[edges]])
+    node_bad = (below[component] & ~compat[licenses]).any(axis=1)
+    numpy.logical_or.at(bad, component, node_bad)
+    for level in levels:
+        edges = height[src] == level
+        numpy.logical_or.at(bad, src[edges], bad[dst[edges]])
+
+    nodes = numpy.asarray(nodes, dtype=numpy.intp)
+    incompatible = below[component[nodes]] & ~compat[licenses[nodes]]
+    result = []
+    for i, node in enumerate(nodes):
+        ids = []
+        for w in numpy.nonzero(incompatible[i])[0]:
+            value = int(incompatible[i, w])
+            ids.extend([ 64 * int(w) + b for b in _bit_ids(value) ])
+        result.append((graph.ids[node], not bad[component[node]], ids))
+    return result
+
+
+# Buffered writer for gather results. Keeps soname, license and file path to
+# id maps in memory, assigns ids itself, and writes new rows with one
+# executemany() per table per batch, all inside the caller's transaction.
+# Produces the same rows as inserting through the SQLObject classes.
+class BulkWriter(object):
+    stat_columns = ("st_dev", "st_ino", "st_size", "st_mtime_ns", "st_ctime")
+    insert_columns = (
+        ("filedata", ("basename", "full_path") + stat_columns),
+        ("soname", ("soname",)),
+        ("license", ("license", "license_type")),
+        ("dt_needed_list", ("filedata_id", "soname_id")),
+        ("soname_list", ("soname_id", "filedata_id")),
+        ("filedata_license", ("license_id", "filedata_id")),
+        ("blob", ("digest", "data", "size")),
+        ("tag", ("filedata_id", "tagname", "tagvalue")),
+        ("tool_failure", ("filedata_id", "tool", "command", "reason", "attempts", "returncode", "elapsed")),
+        ("journal_dir", ("dirpath",)),
+        ("journal_soname", ("full_path", "soname")),
+        )
+    # the tags an alias shares with the file it is identical to
+    alias_tags = ("FILE", "ELF_CLASS", "ELF_MACHINE", "RPATH", "RUNPATH", "NM", "NM_D", "OBJDUMP")
+
+    def __init__(self, trans, batch_size=1000):
+        self.trans = trans
+        self.db = trans._connection
+        self.ph = {"qmark": "?", "format": "%s", "pyformat": "%s"}[trans._dbConnection.module.paramstyle]
+        self.batch_size = batch_size
+        self.rows = {}
+        self.unflushed = set()
+        self.statement_count = 0
+
+        self.soname_ids = dict(self.query("SELECT soname, id FROM soname"))
+        self.license_ids = {}
+        self.license_types = {}
+        for id, license, license_type in self.query("SELECT id, license, license_type FROM license"):
+            self.license_ids[license] = id
+            self.license_types[id] = license_type
+        self.file_ids = dict(self.query("SELECT full_path, id FROM filedata"))
+        self.failed_ids = set([ r[0] for r in self.query("SELECT DISTINCT filedata_id FROM tool_failure") ])
+        self.blob_digests = set([ r[0] for r in self.query("SELECT digest FROM blob") ])
+        # (filedata id, ALIAS_OF path) of the aliases written so far
+        self.aliases = []
+        self.next_ids = {}
+        for table, columns in self.insert_columns:
+            self.next_ids[table] = (self.query("SELECT MAX(id) FROM %s" % table)[0][0] or 0) + 1
+
+    def sql(self, statement):
+        return statement.replace("?", self.ph)
+
+    def query(self, statement, *args):
+        self.statement_count = self.statement_count + 1
+        cursor = self.db.cursor()
+        cursor.execute(self.sql(statement), args)
+        return cursor.fetchall()
+
+    def execute(self, statement, *args):
+        self.statement_count = self.statement_count + 1
+        cursor = self.db.cursor()
+        cursor.execute(self.sql(statement), args)
+
+    def new_id(self, table):
+        id = self.next_ids[table]
+        self.next_ids[table] = id + 1
+        return id
+
+    def add_row(self, table, values):
+        id = self.new_id(table)
+        self.rows.setdefault(table, []).append((id,) + tuple(values))
+        return id
+
+    decorate(traceLog())
+    def flush(self):
+        # parent tables first
+        for table, columns in self.insert_columns:
+            if not self.rows.get(table): continue
+            statement = "INSERT INTO %s (id, %s) VALUES (%s)" % (table, ", ".join(columns), ", ".join(["?"] * (len(columns) + 1)))
+            self.statement_count = self.statement_count + 1
+            self.db.cursor().executemany(self.sql(statement), self.rows[table])
+        self.rows = {}
+        self.unflushed.clear()
+
+    decorate(traceLog())
+    def commit(self):
+        self.flush()
+        self.trans.commit()
+
+    def soname_id(self, soname):
+        if soname not in self.soname_ids:
+            self.soname_ids[soname] = self.add_row("soname", (soname,))
+        return self.soname_ids[soname]
+
+    def blob_ref(self, value):
+        """store value in the blob table unless it is there already, and
+        return the reference to put in the tag"""
+        digest = blob_digest(value)
+        if digest not in self.blob_digests:
+            self.add_row("blob", (digest, buffer(zlib.compress(value)), len(value)))
+            self.blob_digests.add(digest)
+        return BLOB_PREFIX + digest
+
+    def license_id(self, license, license_type):
+        if license not in self.license_ids:
+            id = self.add_row("license", (license, license_type))
+            self.license_ids[license] = id
+            self.license_types[id] = license_type
+        return self.license_ids[license]
+
+    decorate(traceLog())
+    def insert(self, data):
+        """write one gather result dict. Returns True if anything was added."""
+        full_path = data["full_path"]
+        if full_path in self.unflushed:
+            self.flush()
+
+        sig = data.pop("STAT", None)
+        old_rows = None
+        if full_path in self.file_ids:
+            moduleLogVerbose.debug("UPDATE: %s" % data["basename"])
+            # updates need to see what is already there, so write out
+            # everything buffered first
+            self.flush()
+            fid = self.file_ids[full_path]
+            if sig is not None:
+                self.execute("UPDATE filedata SET %s WHERE id = ?" % ", ".join([ "%s = ?" % c for c in self.stat_columns ]), *(tuple(sig) + (fid,)))
+            # the new results replace what an earlier gather of this file
+            # found. Licenses gather did not set (eg. MANUAL ones) stay.
+            old_rpm_licenses = set([ r[0] for r in self.query("SELECT license_id FROM filedata_license WHERE filedata_id = ?", fid)
+                if self.license_types.get(r[0]) == "RPM" ])
+            old_rows = (
+                set([ r[0] for r in self.query("SELECT soname_id FROM dt_needed_list WHERE filedata_id = ?", fid) ]),
+                set([ r[0] for r in self.query("SELECT soname_id FROM soname_list WHERE filedata_id = ?", fid) ]),
+                old_rpm_licenses,
+                set(self.query("SELECT tagname, tagvalue FROM tag WHERE filedata_id = ?", fid)),
+                )
+            for table in ("dt_needed_list", "soname_list", "tag"):
+                self.execute("DELETE FROM %s WHERE filedata_id = ?" % table, fid)
+            for old in old_rpm_licenses:
+                self.execute("DELETE FROM filedata_license WHERE filedata_id = ? AND license_id = ?", fid, old)
+            # failures from an earlier gather of this file no longer apply
+            if fid in self.failed_ids:
+                self.execute("DELETE FROM tool_failure WHERE filedata_id = ?", fid)
+                self.failed_ids.discard(fid)
+        else:
+            moduleLogVerbose.debug("INSERT: %s" % data["basename"])
+            fid = self.add_row("filedata", (data["basename"], full_path) + tuple(sig or (None,) * 5))
+            self.file_ids[full_path] = fid
+            self.unflushed.add(full_path)
+        have_needed = set()
+        have_sonames = set()
+        have_licenses = set()
+        have_tags = set()
+
+        # add all dt_needed entries
+        for lib in data.pop("DT_NEEDED", []):
+            sid = self.soname_id(lib)
+            if sid not in have_needed:
+                moduleLogVerbose.debug("\tadd DT_NEEDED: %s" % lib)
+                self.add_row("dt_needed_list", (fid, sid))
+                have_needed.add(sid)
+
+        # libraries without a DT_SONAME are linked to the name they were
+        # resolved by, so that the files needing them can find them
+        resolved_soname = data.pop("RESOLVED_SONAME", None)
+        if resolved_soname and not data.get("SONAME"):
+            sid = self.soname_id(resolved_soname)
+            moduleLogVerbose.debug("\tadd resolved SONAME: %s" % resolved_soname)
+            self.add_row("soname_list", (sid, fid))
+            have_sonames.add(sid)
+
+        soname = data.pop("SONAME", None)
+        if soname:
+            sid = self.soname_id(soname)
+            moduleLogVerbose.debug("\tadd SONAME: %s" % soname)
+            self.add_row("soname_list", (sid, fid))
+            have_sonames.add(sid)
+
+        license = data.pop("LICENSE_RPM", None)
+        if license:
+            moduleLogVerbose.debug("\tadd LICENSE: %s" % license)
+            lid = self.license_id(license, "RPM")
+            self.add_row("filedata_license", (lid, fid))
+            have_licenses.add(lid)
+
+        failures = data.pop("TOOL_FAILURES", [])
+        for failure in failures:
+            self.add_row("tool_failure", (fid, failure["tool"], failure["command"], failure["reason"],
+                failure["attempts"], failure["returncode"], failure["elapsed"]))
+            self.failed_ids.add(fid)
+
+        if "ALIAS_OF" in data:
+            self.aliases.append((fid, data["ALIAS_OF"]))
+
+        skip_list = ("full_path", "basename")
+        for key, value in data.items():
+            if key in skip_list: continue
+            if key in BLOB_TAGS and isinstance(value, str) and len(value) > BLOB_THRESHOLD:
+                value = self.blob_ref(value)
+            if (key, value) not in have_tags:
+                moduleLogVerbose.debug("Add TAG: %s --> %s" % (key, value))
+                self.add_row("tag", (fid, key, value))
+                have_tags.add((key, value))
+
+        created_something = bool(failures) or old_rows != (have_needed, have_sonames, have_licenses, have_tags)
+        if created_something:
+            moduleLogVerbose.info("Inserted : %s" % data["basename"])
+        else:
+            moduleLogVerbose.info("Already present : %s" % data["basename"])
+
+        if len(self.unflushed) >= self.batch_size:
+            self.flush()
+        return created_something
+
+    # The progress journal lets an interrupted gather resume. Its rows go
+    # through the same transaction as the data they describe, so they
+    # become durable at the same commit.
+    decorate(traceLog())
+    def start_journal(self, inputs, resume):
+        """returns (completed directories, pending (path, soname) pairs) to
+        resume from, which are empty unless resume is set and the journal
+        belongs to an unfinished run over the same inputs"""
+        state = dict(self.query("SELECT name, value FROM journal_state"))
+        if resume:
+            if state.get("inputs") == "\n".join(inputs):
+                completed = set([ r[0] for r in self.query("SELECT dirpath FROM journal_dir") ])
+                pending = self.query("SELECT full_path, soname FROM journal_soname")
+                moduleLog.info("Resuming: %d directories done, %d libraries pending" % (len(completed), len(pending)))
+                return (completed, pending)
+            moduleLog.warning("No unfinished gather over the same inputs to resume, starting over.")
+        self.clear_journal()
+        self.execute("INSERT INTO journal_state (name, value) VALUES (?, ?)", "inputs", "\n".join(inputs))
+        return (set(), [])
+
+    def journal_dir(self, dirpath):
+        self.add_row("journal_dir", (dirpath,))
+
+    def journal_soname(self, full_path, soname):
+        self.add_row("journal_soname", (full_path, soname))
+
+    decorate(traceLog())
+    def clear_journal(self):
+        self.flush()
+        for table in ("journal_state", "journal_dir", "journal_soname"):
+            self.execute("DELETE FROM %s" % table)
+
+    # Aliases are written as soon as they are found, usually before the file
+    # they are identical to has been analyzed, so they get its DT_NEEDED,
+    # SONAME and ELF tag rows once the run is complete.
+    decorate(traceLog())
+    def resolve_aliases(self):
+        """copy the rows of the analyzed file to the aliases written since
+        the last call"""
+        self.flush()
+        aliases, self.aliases = dict(self.aliases), []
+        pairs = []
+        for fid, primary in aliases.items():
+            # an alias may name another alias written in the same run
+            followed = set([fid])
+            source = self.file_ids.get(primary)
+            while source in aliases and source not in followed:
+                followed.add(source)
+                source = self.file_ids.get(aliases[source])
+            if source is None or source in followed:
+                moduleLogVerbose.info("No analyzed file for alias %s of %s" % (fid, primary))
+                continue
+            pairs.append((fid, source, fid))
+        if not pairs:
+            return
+        statements = (
+            ("dt_needed_list", """INSERT INTO dt_needed_list (filedata_id, soname_id) SELECT ?, soname_id FROM dt_needed_list
+                WHERE filedata_id = ? AND soname_id NOT IN (SELECT soname_id FROM dt_needed_list WHERE filedata_id = ?)"""),
+            ("soname_list", """INSERT INTO soname_list (filedata_id, soname_id) SELECT ?, soname_id FROM soname_list
+                WHERE filedata_id = ? AND soname_id NOT IN (SELECT soname_id FROM soname_list WHERE filedata_id = ?)"""),
+            ("tag", """INSERT INTO tag (filedata_id, tagname, tagvalue) SELECT ?, tagname, tagvalue FROM tag
+                WHERE filedata_id = ? AND tagname IN (%s) AND tagname NOT IN (SELECT tagname FROM tag WHERE filedata_id = ?)"""
+                % ", ".join([ "'%s'" % t for t in self.alias_tags ])),
+            )
+        for table, statement in statements:
+            self.statement_count = self.statement_count + 1
+            self.db.cursor().executemany(self.sql(statement), pairs)
+            # the rows got their ids from the database
+            self.next_ids[table] = (self.query("SELECT MAX(id) FROM %s" % table)[0][0] or 0) + 1
+        moduleLogVerbose.info("Copied analyzed data to %d aliases" % len(pairs))
+
+    decorate(traceLog())
+    def known_needed(self):
+        """(requester, soname, RPATH, RUNPATH, ELF_CLASS) for every DT_NEEDED
+        entry in the database, leaving out files from container images,
+        whose sonames were resolved within the image"""
+        self.flush()
+        return self.query("""SELECT f.full_path, s.soname, rp.tagvalue, rn.tagvalue, ec.tagvalue
+            FROM dt_needed_list d
+            JOIN filedata f ON f.id = d.filedata_id
+            JOIN soname s ON s.id = d.soname_id
+            LEFT JOIN tag rp ON rp.filedata_id = f.id AND rp.tagname = 'RPATH'
+            LEFT JOIN tag rn ON rn.filedata_id = f.id AND rn.tagname = 'RUNPATH'
+            LEFT JOIN tag ec ON ec.filedata_id = f.id AND ec.tagname = 'ELF_CLASS'
+            WHERE NOT EXISTS (SELECT 1 FROM tag l WHERE l.filedata_id = f.id AND l.tagname = 'LAYER')""")
+
+    decorate(traceLog())
+    def delete_files(self, full_paths):
+        self.flush()
+        ids = [ (self.file_ids.pop(p),) for p in full_paths if p in self.file_ids ]
+        for table in ("tag", "dt_needed_list", "soname_list", "filedata_license", "tool_failure"):
+            self.statement_count = self.statement_count + 1
+            self.db.cursor().executemany(self.sql("DELETE FROM %s WHERE filedata_id = ?" % table), ids)
+        self.statement_count = self.statement_count + 1
+        self.db.cursor().executemany(self.sql("DELETE FROM filedata WHERE id = ?"), ids)
+
+    decorate(traceLog())
+    def create_indexes(self):
+        """create the indexes a bulk load left out"""
+        self.flush()
+        create_indexes(self.trans)
+
+    decorate(traceLog())
+    def resolve_licenses(self):
+        self.flush()
+        resolve_licenses(self.trans)
+
+# Merge another gather database (an sqlite file) into the one 'trans' is
+# connected to, which must also be sqlite. Files are matched by full_path,
+# with the merged-in copy replacing any existing one; sonames and licenses
+# are matched by name. Everything is done with set-based SQL over an
+# ATTACHed database, so the rows never pass through python.
+decorate(traceLog())
+def merge_database(trans, src_fn):
+    db = trans._connection
+    cursor = db.cursor()
+    cursor.execute("ATTACH DATABASE ? AS src", (src_fn,))
+    try:
+        def columns(table):
+            return [ r[1] for r in cursor.execute("PRAGMA src.table_info(%s)" % table).fetchall() ]
+        src_tables = [ r[0] for r in cursor.execute("SELECT name FROM src.sqlite_master WHERE type = 'table'").fetchall() ]
+
+        cursor.execute("INSERT INTO main.soname (soname) SELECT DISTINCT soname FROM src.soname WHERE soname NOT IN (SELECT soname FROM main.soname)")
+        cursor.execute("INSERT INTO main.license (license, license_type) SELECT license, MIN(license_type) FROM src.license WHERE license NOT IN (SELECT license FROM main.license) GROUP BY license")
+        # blobs are content addressed, so tags can refer to them unchanged
+        if "blob" in src_tables:
+            cursor.execute("INSERT INTO main.blob (digest, data, size) SELECT digest, data, size FROM src.blob WHERE digest NOT IN (SELECT digest FROM main.blob)")
+
+        # drop the existing copies of files that are being merged in
+        cursor.execute("CREATE TEMP TABLE replaced AS SELECT m.id AS id FROM main.filedata m JOIN src.filedata s ON s.full_path = m.full_path")
+        for table in ("tag", "dt_needed_list", "soname_list", "filedata_license", "tool_failure"):
+            cursor.execute("DELETE FROM main.%s WHERE filedata_id IN (SELECT id FROM temp.replaced)" % table)
+        cursor.execute("DELETE FROM main.filedata WHERE id IN (SELECT id FROM temp.replaced)")
+
+        # databases from before the stat columns existed get NULLs
+        have = columns("filedata")
+        stat = ", ".join([ c in have and c or "NULL" for c in BulkWriter.stat_columns ])
+        cursor.execute("INSERT INTO main.filedata (basename, full_path, %s) SELECT basename, full_path, %s FROM src.filedata" % (", ".join(BulkWriter.stat_columns), stat))
+
+        # old id -> new id
+        cursor.execute("CREATE TEMP TABLE file_map AS SELECT s.id AS src_id, m.id AS dst_id FROM src.filedata s JOIN main.filedata m ON m.full_path = s.full_path")
+        cursor.execute("CREATE TEMP TABLE soname_map AS SELECT s.id AS src_id, m.id AS dst_id FROM src.soname s JOIN main.soname m ON m.soname = s.soname")
+        cursor.execute("CREATE TEMP TABLE license_map AS SELECT s.id AS src_id, m.id AS dst_id FROM src.license s JOIN main.license m ON m.license = s.license")
+        for table in ("file_map", "soname_map", "license_map"):
+            cursor.execute("CREATE UNIQUE INDEX temp.%s_src ON %s (src_id)" % (table, table))
+
+        cursor.execute("""INSERT INTO main.dt_needed_list (filedata_id, soname_id)
+            SELECT f.dst_id, s.dst_id FROM src.dt_needed_list d
+            JOIN temp.file_map f ON f.src_id = d.filedata_id JOIN temp.soname_map s ON s.src_id = d.soname_id""")
+        cursor.execute("""INSERT INTO main.soname_list (soname_id, filedata_id)
+            SELECT s.dst_id, f.dst_id FROM src.soname_list d
+            JOIN temp.file_map f ON f.src_id = d.filedata_id JOIN temp.soname_map s ON s.src_id = d.soname_id""")
+        cursor.execute("""INSERT INTO main.filedata_license (license_id, filedata_id)
+            SELECT l.dst_id, f.dst_id FROM src.filedata_license d
+            JOIN temp.file_map f ON f.src_id = d.filedata_id JOIN temp.license_map l ON l.src_id = d.license_id""")
+        cursor.execute("""INSERT INTO main.tag (filedata_id, tagname, tagvalue)
+            SELECT f.dst_id, t.tagname, t.tagvalue FROM src.tag t JOIN temp.file_map f ON f.src_id = t.filedata_id""")
+        if "tool_failure" in src_tables:
+            cursor.execute("""INSERT INTO main.tool_failure (filedata_id, tool, command, reason, attempts, returncode, elapsed)
+                SELECT f.dst_id, t.tool, t.command, t.reason, t.attempts, t.returncode, t.elapsed
+                FROM src.tool_failure t JOIN temp.file_map f ON f.src_id = t.filedata_id""")
+
+        merged = cursor.execute("SELECT COUNT(*) FROM temp.file_map").fetchone()[0]
+        replaced = cursor.execute("SELECT COUNT(*) FROM temp.replaced").fetchone()[0]
+        trans.commit()
+    except Exception, e:
+        trans.rollback()
+        raise
+    finally:
+        for table in ("replaced", "file_map", "soname_map", "license_map"):
+            cursor.execute("DROP TABLE IF EXISTS temp.%s" % table)
+        cursor.execute("DETACH DATABASE src")
+    return (merged, replaced)
+
 # centralized place to set common sqlmeta class details
 class myMeta(sqlobject.sqlmeta):
     lazyUpdate = False
@@ -155,6 +1038,17 @@ class Filedata(sqlobject.SQLObject):
     class sqlmeta(myMeta): pass
     basename  = sqlobject.StringCol()
     full_path = sqlobject.StringCol(alternateID=True)
+    # stat signature of the file when it was gathered, used to skip
+    # unchanged files on later runs
+    st_dev = sqlobject.BigIntCol(default=None)
+    st_ino = sqlobject.BigIntCol(default=None)
+    st_size = sqlobject.BigIntCol(default=None)
+    st_mtime_ns = sqlobject.BigIntCol(default=None)
+    st_ctime = sqlobject.FloatCol(default=None)
+    # effective license, see resolve_licenses()
+    resolved_license = sqlobject.StringCol(default=None)
+    basename_index = sqlobject.DatabaseIndex('basename')
+    resolved_license_index = sqlobject.DatabaseIndex('resolved_license')
     dt_needed = sqlobject.RelatedJoin('Soname', joinColumn='filedata_id', otherColumn='soname_id', intermediateTable='dt_needed_list', addRemoveName='DtNeeded')
     soname = sqlobject.RelatedJoin('Soname', joinColumn='filedata_id', otherColumn='soname_id', intermediateTable='soname_list', addRemoveName='Soname')
     license  = sqlobject.RelatedJoin('License', joinColumn='filedata_id', otherColumn='license_id', intermediateTable='filedata_license', addRemoveName='License')
@@ -165,6 +1059,9 @@ class Filedata(sqlobject.SQLObject):
 class Soname(sqlobject.SQLObject):
     class sqlmeta(myMeta): pass
     soname = sqlobject.StringCol(alternateID=True)
+    # effective license, see resolve_licenses()
+    resolved_license = sqlobject.StringCol(default=None)
+    resolved_license_index = sqlobject.DatabaseIndex('resolved_license')
     needed_by = sqlobject.RelatedJoin('Filedata', otherColumn='filedata_id', joinColumn='soname_id', intermediateTable='dt_needed_list', addRemoveName='FileThatRequires')
     has_soname = sqlobject.RelatedJoin('Filedata', otherColumn='filedata_id', joinColumn='soname_id', intermediateTable='soname_list', addRemoveName='FileWithSoname')
 
@@ -172,11 +1069,15 @@ class DtNeededList(sqlobject.SQLObject):
     class sqlmeta(myMeta): pass
     filedata = sqlobject.ForeignKey('Filedata', cascade=True)
     soname = sqlobject.ForeignKey('Soname', cascade=True)
+    filedata_index = sqlobject.DatabaseIndex('filedata')
+    soname_index = sqlobject.DatabaseIndex('soname')
 
 class SonameList(sqlobject.SQLObject):
     class sqlmeta(myMeta): pass
     soname = sqlobject.ForeignKey('Soname', cascade=True)
     filedata = sqlobject.ForeignKey('Filedata', cascade=True)
+    filedata_index = sqlobject.DatabaseIndex('filedata')
+    soname_index = sqlobject.DatabaseIndex('soname')
 
 class License(sqlobject.SQLObject):
     class sqlmeta(myMeta): pass
@@ -188,13 +1089,53 @@ class FiledataLicense(sqlobject.SQLObject):
     class sqlmeta(myMeta): pass
     license = sqlobject.ForeignKey('License', cascade=True)
     filedata = sqlobject.ForeignKey('Filedata', cascade=True)
+    filedata_index = sqlobject.DatabaseIndex('filedata')
 
 class Tag(sqlobject.SQLObject):
     class sqlmeta(myMeta): pass
     filedata = sqlobject.ForeignKey('Filedata', cascade=True)
     tagname = sqlobject.StringCol()
     tagvalue = sqlobject.StringCol()
+    filedata_index = sqlobject.DatabaseIndex('filedata')
+
+# large tag values, zlib compressed and stored once per distinct content
+class Blob(sqlobject.SQLObject):
+    class sqlmeta(myMeta): pass
+    digest = sqlobject.StringCol(alternateID=True)
+    data = sqlobject.BLOBCol()
+    size = sqlobject.IntCol()
 
+# external tool calls that still failed after all retries while gathering
+# a file
+class ToolFailure(sqlobject.SQLObject):
+    class sqlmeta(myMeta): pass
+    filedata = sqlobject.ForeignKey('Filedata', cascade=True)
+    tool = sqlobject.StringCol()
+    command = sqlobject.StringCol()
+    reason = sqlobject.StringCol()
+    attempts = sqlobject.IntCol()
+    returncode = sqlobject.IntCol(default=None)
+    elapsed = sqlobject.FloatCol()
+
+# progress journal of the gather run in progress
+class JournalState(sqlobject.SQLObject):
+    class sqlmeta(myMeta): pass
+    name = sqlobject.StringCol(alternateID=True)
+    value = sqlobject.StringCol()
+
+# walked directories whose files have all been written
+class JournalDir(sqlobject.SQLObject):
+    class sqlmeta(myMeta): pass
+    dirpath = sqlobject.StringCol()
+
+# libraries queued by the soname closure
+class JournalSoname(sqlobject.SQLObject):
+    class sqlmeta(myMeta): pass
+    full_path = sqlobject.StringCol()
+    soname = sqlobject.StringCol()
+
+# tables that older databases may lack
+added_tables = (ToolFailure, JournalState, JournalDir, JournalSoname, Blob)
 
 def iterTables():
     # fancy pants way to grab all classes in this file
@@ -211,8 +1152,73 @@ def dropTables():
     for clas in iterTables():
         clas.dropTable(ifExists=True, dropJoinTables=True, cascade=True)
 
-def createTables():
+def createTables(createIndexes=True):
     for clas in iterTables():
-        clas.createTable(ifNotExists=True, createJoinTables=False)
+        clas.createTable(ifNotExists=True, createJoinTables=False, createIndexes=createIndexes)
+
+# The schema checks below read the catalog of sqlite, mysql and postgres
+# databases. On other backends they return None and the checks are skipped.
+
+def table_columns(conn, table):
+    if conn.dbName == "sqlite":
+        return [ r[1] for r in conn.queryAll("PRAGMA table_info(%s)" % table) ]
+    if conn.dbName == "mysql":
+        return [ r[0] for r in conn.queryAll("SHOW COLUMNS FROM %s" % table) ]
+    if conn.dbName == "postgres":
+        return [ r[0] for r in conn.queryAll("SELECT column_name FROM information_schema.columns WHERE table_name = %s" % conn.sqlrepr(table)) ]
+    return None
+
+# names of the indexes that exist on a table, as SQLObject names them when
+# it creates them (see SODatabaseIndex.*CreateIndexSQL)
+def index_names(conn, table):
+    if conn.dbName == "mysql":
+        return [ r[2] for r in conn.queryAll("SHOW INDEX FROM %s" % table) ]
+    if conn.dbName == "sqlite":
+        rows = conn.queryAll("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s" % conn.sqlrepr(table))
+    elif conn.dbName == "postgres":
+        rows = conn.queryAll("SELECT indexname FROM pg_indexes WHERE tablename = %s" % conn.sqlrepr(table))
+    else:
+        return None
+    return [ r[0] for r in rows ]
+
+# create any indexes that do not exist yet
+def create_indexes(connection=None):
+    for clas in iterTables():
+        conn = connection or clas._connection
+        table = clas.sqlmeta.table
+        have = index_names(conn, table)
+        if have is None:
+            moduleLog.warning("Cannot list the indexes of a %s database, not adding missing ones" % conn.dbName)
+            return
+        for index in clas.sqlmeta.indexes:
+            name = index.name
+            if conn.dbName != "mysql":
+                name = "%s_%s" % (table, index.name)
+            if name in have:
+                continue
+            conn.query(conn.createIndexSQL(clas, index))
+            moduleLogVerbose.info("Added index %s on %s" % (index.name, table))
+
+# add any tables and columns that were introduced after the database was created
+def upgradeTables():
+    unchecked = []
+    for clas in iterTables():
+        conn = clas._connection
+        if not clas.tableExists():
+            moduleLogVerbose.info("Adding table %s" % clas.sqlmeta.table)
+            clas.createTable(createJoinTables=False)
+            continue
+        have = table_columns(conn, clas.sqlmeta.table)
+        if have is None:
+            unchecked.append(clas.sqlmeta.table)
+            continue
+        for col in clas.sqlmeta.columnList:
+            if col.dbName not in have:
+                moduleLogVerbose.info("Adding column %s.%s" % (clas.sqlmeta.table, col.dbName))
+                conn.addColumn(clas.sqlmeta.table, col)
+    if unchecked:
+        moduleLog.warning("Cannot list the columns of a %s database, not adding missing ones to %s" % (conn.dbName, ", ".join(unchecked)))
+    # also completes the indexes of a bulk load that was interrupted
+    create_indexes()
 
 
@@ -0,0 +1,113 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    Interchange format for gather results: gzip compressed, append-only,
+    newline-delimited JSON. The first line of each file is a header naming
+    the schema and its version, every following line is one gather data
+    dict. Each batch of records is appended as its own gzip member, so a
+    file that was cut off in the middle of a write is still readable up to
+    the last complete batch.
+
+    Gather data holds byte strings (nm and objdump output are not
+    necessarily UTF-8), so strings are written as latin-1 code points and
+    turned back into the same bytes on reading.
+"""
+
+import os
+import json
+import gzip
+import socket
+
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+class NdjsonError(Exception): pass
+
+SCHEMA_NAME = "license-scanner-gather"
+# bump for incompatible changes to the record layout
+SCHEMA_VERSION = 1
+
+FILE_SUFFIX = ".ndjson.gz"
+
+def _to_bytes(obj):
+    if isinstance(obj, unicode):
+        return obj.encode("latin-1")
+    if isinstance(obj, list):
+        return [ _to_bytes(o) for o in obj ]
+    if isinstance(obj, dict):
+        return dict([ (_to_bytes(k), _to_bytes(v)) for k, v in obj.items() ])
+    return obj
+
+def encode(record):
+    return json.dumps(record, encoding="latin-1", sort_keys=True, separators=(",", ":"))
+
+def decode(line):
+    return _to_bytes(json.loads(line))
+
+class NdjsonWriter(object):
+    """appends records to a file of its own in 'directory', so that any
+    number of processes can write side by side without locking"""
+    def __init__(self, directory, name=None):
+        self.directory = directory
+        self.name = name
+        self.records = 0
+
+    def path(self):
+        # decided at write time, so that a writer inherited by a forked
+        # process does not share its parent's file
+        name = self.name
+        if name is None:
+            name = "gather-%s-%d" % (socket.gethostname(), os.getpid())
+        return os.path.join(self.directory, name + FILE_SUFFIX)
+
+    decorate(traceLog())
+    def write(self, records):
+        if not records:
+            return
+        path = self.path()
+        lines = []
+        if not os.path.exists(path):
+            lines.append(encode({"schema": SCHEMA_NAME, "version": SCHEMA_VERSION}))
+        lines.extend([ encode(r) for r in records ])
+        fd = gzip.open(path, "ab")
+        try:
+            fd.write("\n".join(lines) + "\n")
+        finally:
+            fd.close()
+        self.records = self.records + len(records)
+
+def list_files(paths):
+    """expand directories in paths to the NDJSON files they contain"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted([ os.path.join(path, fn) for fn in os.listdir(path) if fn.endswith(FILE_SUFFIX) ]))
+        else:
+            files.append(path)
+    return files
+
+decorate(traceLog())
+def iter_records(path):
+    """yield the records of one NDJSON file, checking its header"""
+    fd = gzip.open(path, "rb")
+    try:
+        header = None
+        try:
+            for line in fd:
+                if not line.strip():
+                    continue
+                record = decode(line)
+                if header is None:
+                    header = record
+                    if header.get("schema") != SCHEMA_NAME:
+                        raise NdjsonError("%s is not a gather results file" % path)
+                    if header.get("version") != SCHEMA_VERSION:
+                        raise NdjsonError("%s has schema version %s, expected %s" % (path, header.get("version"), SCHEMA_VERSION))
+                    continue
+                yield record
+        except (IOError, EOFError, ValueError), e:
+            # a batch that was cut off; everything before it was complete
+            moduleLog.warning("Stopped reading %s at a damaged record: %s" % (path, e))
+    finally:
+        fd.close()
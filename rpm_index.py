@@ -0,0 +1,113 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    One-shot index of the installed RPM database: maps every file path owned
+    by a package to that package's (license, NEVRA). Building it walks all
+    installed headers once, which is far cheaper than a dbMatch() per file.
+    The index can be saved to a snapshot file and is reused as long as the
+    rpmdb has not changed since the snapshot was taken.
+"""
+
+import os
+import cPickle
+import rpm
+
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+# bump if the layout of the pickled snapshot changes
+SNAPSHOT_VERSION = 1
+
+def rpmdb_path():
+    return rpm.expandMacro("%_dbpath")
+
+decorate(traceLog())
+def rpmdb_mtime():
+    """latest modification time of the rpmdb directory or any file in it"""
+    dbpath = rpmdb_path()
+    try:
+        mtime = os.stat(dbpath).st_mtime
+        for name in os.listdir(dbpath):
+            mtime = max(mtime, os.stat(os.path.join(dbpath, name)).st_mtime)
+    except OSError, e:
+        return None
+    return mtime
+
+def header_nevra(h):
+    if h['epoch'] is not None:
+        return "%s-%s:%s-%s.%s" % (h['name'], h['epoch'], h['version'], h['release'], h['arch'])
+    return "%s-%s-%s.%s" % (h['name'], h['version'], h['release'], h['arch'])
+
+decorate(traceLog())
+def build_index():
+    index = {}
+    ts = rpm.TransactionSet()
+    for h in ts.dbMatch():
+        # one tuple per package, shared by all of its files
+        pkg = (intern(h['license'] or ""), header_nevra(h))
+        for fn in h['filenames'] or []:
+            index[fn] = pkg
+    moduleLogVerbose.info("RPM index built: %d files" % len(index))
+    return index
+
+decorate(traceLog())
+def load_snapshot(snapshot_fn, mtime):
+    try:
+        fd = open(snapshot_fn, "rb")
+    except IOError, e:
+        return None
+    try:
+        try:
+            header = cPickle.load(fd)
+            if header != {"version": SNAPSHOT_VERSION, "dbpath": rpmdb_path(), "mtime": mtime}:
+                moduleLogVerbose.info("RPM index snapshot %s is stale." % snapshot_fn)
+                return None
+            return cPickle.load(fd)
+        except (EOFError, cPickle.UnpicklingError, ValueError), e:
+            moduleLogVerbose.info("Ignoring unreadable RPM index snapshot %s: %s" % (snapshot_fn, e))
+            return None
+    finally:
+        fd.close()
+
+decorate(traceLog())
+def save_snapshot(snapshot_fn, mtime, index):
+    tmp_fn = "%s.tmp.%d" % (snapshot_fn, os.getpid())
+    try:
+        fd = open(tmp_fn, "wb")
+        try:
+            cPickle.dump({"version": SNAPSHOT_VERSION, "dbpath": rpmdb_path(), "mtime": mtime}, fd, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(index, fd, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            fd.close()
+        os.rename(tmp_fn, snapshot_fn)
+    except (IOError, OSError), e:
+        moduleLog.warning("Could not save RPM index snapshot %s: %s" % (snapshot_fn, e))
+        if os.path.exists(tmp_fn):
+            os.unlink(tmp_fn)
+
+decorate(traceLog())
+def load_index(snapshot_fn=None):
+    """return the path -> (license, nevra) index, using the snapshot file if
+    it is still current and refreshing it if not"""
+    mtime = rpmdb_mtime()
+    if snapshot_fn and mtime is not None:
+        index = load_snapshot(snapshot_fn, mtime)
+        if index is not None:
+            moduleLogVerbose.info("Using RPM index snapshot %s" % snapshot_fn)
+            return index
+
+    index = build_index()
+    if snapshot_fn and mtime is not None:
+        save_snapshot(snapshot_fn, mtime, index)
+    return index
+
+def lookup(index, full_path):
+    pkg = index.get(full_path)
+    if pkg is None:
+        # the rpmdb records canonical paths, the scan may have gone
+        # through a symlinked directory like /lib -> /usr/lib
+        real_path = os.path.realpath(full_path)
+        if real_path != full_path:
+            pkg = index.get(real_path)
+    return pkg
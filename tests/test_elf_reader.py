@@ -0,0 +1,67 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+#
+# Run from the top of the tree with: python -m unittest discover tests
+
+import os
+import sys
+import random
+import struct
+import tempfile
+import unittest
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+import elf_reader
+
+# offsets of e_phoff and e_shoff in the ELF header, per class
+header_offsets = {
+    elf_reader.ELFCLASS32: (28, 32, "I"),
+    elf_reader.ELFCLASS64: (32, 40, "Q"),
+    }
+
+class CorruptHeaderTest(unittest.TestCase):
+    def setUp(self):
+        self.image = open(os.path.realpath(sys.executable), "rb").read()
+        if self.image[:4] != elf_reader.ELF_MAGIC:
+            self.skipTest("needs an ELF python executable")
+        self.elf_class = ord(self.image[4])
+        self.endian = ord(self.image[5]) == elf_reader.ELFDATA2LSB and "<" or ">"
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def read(self, image):
+        open(self.path, "wb").write(image)
+        return elf_reader.read_elf_file(self.path)
+
+    def patched(self, offset, value):
+        fmt = self.endian + header_offsets[self.elf_class][2]
+        return self.image[:offset] + struct.pack(fmt, value) + self.image[offset + struct.calcsize(fmt):]
+
+    def test_intact(self):
+        self.assertTrue(self.read(self.image)["dynamic"])
+
+    def test_huge_phoff(self):
+        phoff, shoff, fmt = header_offsets[self.elf_class]
+        self.assertRaises(elf_reader.ElfError, self.read, self.patched(phoff, 1 << (struct.calcsize(fmt) * 8 - 1)))
+
+    def test_huge_shoff(self):
+        phoff, shoff, fmt = header_offsets[self.elf_class]
+        self.assertRaises(elf_reader.ElfError, self.read, self.patched(shoff, 1 << (struct.calcsize(fmt) * 8 - 1)))
+
+    def test_mutated_headers(self):
+        # anything but ElfError escapes and fails the test
+        rand = random.Random(1)
+        for i in range(500):
+            image = list(self.image[:4096])
+            for j in range(rand.randint(1, 8)):
+                image[rand.randrange(4, 64)] = chr(rand.randrange(256))
+            try:
+                self.read("".join(image) + self.image[4096:])
+            except elf_reader.ElfError, e:
+                pass
+
+if __name__ == "__main__":
+    unittest.main()
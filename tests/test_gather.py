@@ -0,0 +1,76 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+#
+# Run from the top of the tree with: python -m unittest discover tests
+
+import os
+import sys
+import imp
+import shutil
+import tempfile
+import unittest
+import subprocess
+import distutils.spawn
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+gather = imp.load_source("gather", os.path.join(top, "gather"))
+
+class Opts(object):
+    cmd_objdump = "objdump"
+    batch_size = 64
+    tool_timeout = 60.0
+    tool_retries = 0
+    tool_concurrency = 1
+
+def have(*tools):
+    return [ t for t in tools if distutils.spawn.find_executable(t) is None ] == []
+
+class BatchObjdumpTest(unittest.TestCase):
+    def setUp(self):
+        if not have("gcc", "ar", "objdump"):
+            self.skipTest("needs gcc, ar and objdump")
+        self.dir = tempfile.mkdtemp()
+        def run(*cmd):
+            subprocess.check_call(cmd, cwd=self.dir)
+        open(os.path.join(self.dir, "a.c"), "w").write("int f(void) { return 1; }\n")
+        open(os.path.join(self.dir, "b.c"), "w").write("int g(void) { return 2; }\n")
+        run("gcc", "-fPIC", "-c", "a.c", "b.c")
+        run("ar", "rc", "libab.a", "a.o", "b.o")
+        run("gcc", "-shared", "-o", "liba.so", "a.o")
+        run("gcc", "-shared", "-o", "libb.so", "b.o")
+        self.so = os.path.join(self.dir, "liba.so")
+        self.so2 = os.path.join(self.dir, "libb.so")
+        self.ar = os.path.join(self.dir, "libab.a")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, paths):
+        failures = {}
+        res = gather.batch_objdump(Opts(), paths, failures)
+        self.assertEqual(failures, {})
+        self.assertEqual(sorted(res.keys()), sorted(paths))
+        for path in [ p for p in paths if p != self.ar ]:
+            self.assertTrue(res[path].startswith("file format"), res[path][:80])
+            self.assertFalse("In archive" in res[path])
+            self.assertFalse("a.o:" in res[path])
+        self.assertTrue(res[self.ar].startswith("In archive:"), res[self.ar][:80])
+        self.assertTrue("\na.o:     file format" in res[self.ar])
+        self.assertTrue("\nb.o:     file format" in res[self.ar])
+        for text in res.values():
+            self.assertFalse(self.dir in text)
+
+    def test_archive_between_libraries(self):
+        self.check([self.so, self.ar, self.so2])
+
+    def test_archive_first_and_last(self):
+        self.check([self.ar, self.so])
+        self.check([self.so, self.ar])
+
+    def test_same_output_as_single_runs(self):
+        batched = gather.batch_objdump(Opts(), [self.so, self.ar, self.so2], {})
+        for path in (self.so, self.ar, self.so2):
+            self.assertEqual(batched[path], gather.batch_objdump(Opts(), [path], {})[path])
+
+if __name__ == "__main__":
+    unittest.main()
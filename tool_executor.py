@@ -0,0 +1,143 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    Run external tools concurrently with a limit on how many copies of each
+    tool run at once, a timeout after which the tool is killed, and a
+    bounded number of retries. Calls that time out, are killed by a signal
+    or cannot be started produce a failure record instead of output, so one
+    pathological input cannot stall a worker forever.
+"""
+
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+class ToolError(Exception):
+    def __init__(self, record):
+        Exception.__init__(self, "%(tool)s %(reason)s after %(attempts)d attempts" % record)
+        self.record = record
+
+class Executor(object):
+    def __init__(self, timeout=300.0, retries=1, concurrency=4, metrics=None):
+        """timeout is in seconds (0 for none), retries is the number of extra
+        attempts after a failure, concurrency the number of simultaneous
+        calls allowed per tool. Each attempt is recorded as stage
+        'tool.<name>' in metrics, if given."""
+        self.timeout = timeout
+        self.retries = retries
+        self.concurrency = concurrency
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def semaphore(self, tool):
+        self.lock.acquire()
+        try:
+            if tool not in self.semaphores:
+                self.semaphores[tool] = threading.BoundedSemaphore(self.concurrency)
+            return self.semaphores[tool]
+        finally:
+            self.lock.release()
+
+    def run_once(self, cmd):
+        """returns (output, failure reason or None, returncode)"""
+        null = open("/dev/null", "w")
+        try:
+            try:
+                # own process group, so that a kill also reaches anything the
+                # tool started (which would otherwise keep the pipe open)
+                p = subprocess.Popen(cmd, stderr=null, stdout=subprocess.PIPE, stdin=null, preexec_fn=os.setpgrp)
+            except OSError, e:
+                return ("", "could not be started: %s" % e, None)
+            timed_out = []
+            def kill():
+                timed_out.append(True)
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError, e:
+                    pass
+            timer = None
+            if self.timeout:
+                timer = threading.Timer(self.timeout, kill)
+                timer.start()
+            try:
+                output = p.communicate()[0]
+            finally:
+                if timer is not None:
+                    timer.cancel()
+        finally:
+            null.close()
+        if timed_out:
+            return (output, "timed out after %ss" % self.timeout, p.returncode)
+        # a non-zero exit is normal for these tools (eg. nm on a file
+        # without symbols), only death by signal counts as a failure
+        if p.returncode < 0:
+            return (output, "killed by signal %d" % -p.returncode, p.returncode)
+        return (output, None, p.returncode)
+
+    decorate(traceLog())
+    def run(self, cmd):
+        """run cmd, returning its output. Raises ToolError with a failure
+        record once all attempts have failed."""
+        tool = os.path.basename(cmd[0])
+        sem = self.semaphore(tool)
+        start = time.time()
+        attempts = 0
+        while True:
+            attempts = attempts + 1
+            sem.acquire()
+            try:
+                call_start = time.time()
+                output, reason, returncode = self.run_once(cmd)
+                if self.metrics is not None:
+                    self.metrics.observe("tool." + tool, time.time() - call_start)
+                    if reason is not None:
+                        self.metrics.count("tool_failures." + tool)
+            finally:
+                sem.release()
+            if reason is None:
+                return output
+            moduleLogVerbose.info("%s %s (attempt %d)" % (tool, reason, attempts))
+            if attempts > self.retries:
+                raise ToolError({"tool": tool, "command": " ".join(cmd), "reason": reason,
+                    "attempts": attempts, "returncode": returncode, "elapsed": time.time() - start})
+
+    def run_all(self, cmds):
+        """run all commands concurrently, returning a list of
+        (output, failure record or None) in the same order"""
+        return parallel([ (self.run_record, (cmd,)) for cmd in cmds ])
+
+    def run_record(self, cmd):
+        try:
+            return (self.run(cmd), None)
+        except ToolError, e:
+            return ("", e.record)
+
+def parallel(calls):
+    """run each (func, args) in its own thread and return their results in
+    order. An exception in any of them is re-raised in the caller."""
+    if len(calls) == 1:
+        func, args = calls[0]
+        return [ func(*args) ]
+    results = [None] * len(calls)
+    errors = []
+    def run(i, func, args):
+        try:
+            results[i] = func(*args)
+        except Exception, e:
+            errors.append(sys.exc_info())
+    threads = [ threading.Thread(target=run, args=(i, func, args)) for i, (func, args) in enumerate(calls) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
@@ -0,0 +1,434 @@
+# vim:tw=0:expandtab:autoindent:tabstop=4:shiftwidth=4:filetype=python:
+"""
+    Bounded producer -> workers -> writer pipeline.
+
+    A producer thread submits work items, which are grouped into chunks and
+    put on a bounded task queue, so the producer blocks when the workers fall
+    behind. Worker processes turn each chunk into a list of results. The
+    writer runs in the calling thread and consumes results from a bounded
+    done queue, so workers block when the writer falls behind. Completion is
+    tracked by counting chunks rather than polling queue sizes.
+
+    The number of workers can be changed while the pipeline runs, and
+    WorkerTuner does so from the measured throughput and queue depths.
+    Every worker process the pool may grow to is forked in start(), before
+    any other thread exists whose locks a child could inherit while held.
+    Resizing only switches workers on and off.
+
+    A worker that dies without answering (killed, or crashed in native
+    code) has its chunk handed to another worker. Answers are written
+    synchronously (DoneQueue), so one that was sent is never lost with its
+    worker. If the chunk kills a
+    second worker as well, it is dropped with an error.
+"""
+
+import sys
+import time
+import threading
+import traceback
+import collections
+import multiprocessing
+import Queue
+
+from trace_decorator import decorate, traceLog, getLog
+
+moduleLog = getLog()
+moduleLogVerbose = getLog(prefix="verbose.")
+
+# how often a chunk is handed out before it is given up on
+MAX_ATTEMPTS = 2
+
+def _worker(task_queue, done_queue, func, args, enabled, current):
+    while True:
+        # a worker that is switched off finishes its chunk and waits here
+        enabled.wait()
+        task = task_queue.get()
+        if task == 'STOP':
+            break
+        chunk_id, chunk = task
+        current.value = chunk_id
+        try:
+            results = func(*(args + (chunk,)))
+        except Exception, e:
+            # always answer, otherwise the writer waits for this chunk forever
+            sys.stderr.write("Worker failed on a chunk of %d items:\n" % len(chunk))
+            traceback.print_exc()
+            results = []
+        done_queue.put((chunk_id, results))
+        current.value = 0
+
+class PipelineError(Exception): pass
+
+class DoneQueue(object):
+    """bounded queue of answers from the workers. Unlike
+    multiprocessing.Queue, put() has written the answer to the pipe when it
+    returns, so a worker that dies after answering cannot take the answer
+    with it in a feeder thread buffer."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+        self.write_lock = multiprocessing.Lock()
+        self.slots = multiprocessing.BoundedSemaphore(maxsize)
+
+    def put(self, obj):
+        self.slots.acquire()
+        self.write_lock.acquire()
+        try:
+            self.writer.send(obj)
+        finally:
+            self.write_lock.release()
+
+    def get(self, timeout=None):
+        """only call this from one thread"""
+        if not self.reader.poll(timeout):
+            raise Queue.Empty
+        obj = self.reader.recv()
+        self.slots.release()
+        return obj
+
+    def qsize(self):
+        return self.maxsize - self.slots.get_value()
+
+class Pipeline(object):
+    def __init__(self, func, args=(), workers=1, chunk_size=64, queue_depth=None, max_workers=None):
+        """func(*args + (chunk,)) is run in the worker processes and must
+        return a list of results. queue_depth is the number of chunks that
+        may be waiting in each queue. resize() can grow the pool up to
+        max_workers (default: workers)."""
+        if queue_depth is None:
+            queue_depth = 2 * workers
+        self.func = func
+        self.args = tuple(args)
+        self.num_workers = workers
+        self.max_workers = max(workers, max_workers or workers)
+        self.chunk_size = chunk_size
+        self.queue_depth = queue_depth
+        self.task_queue = multiprocessing.Queue(queue_depth)
+        self.done_queue = DoneQueue(queue_depth)
+        # (process, enabled event, id of the chunk it is working on or 0)
+        self.workers = []
+
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.results_written = 0
+        self.chunk = []
+        self.deferred = collections.deque()
+        self.producer = None
+        self.producer_done = True
+        self.producer_error = None
+        # chunk id -> (chunk, attempts) for every chunk given to the workers
+        # and not answered yet
+        self.next_chunk_id = 1
+        self.outstanding = {}
+        # (chunk, attempts) of chunks whose worker died, to be queued again
+        self.retries = collections.deque()
+
+    def start(self):
+        """fork the workers. Call this before starting any threads."""
+        for i in range(self.max_workers):
+            enabled = multiprocessing.Event()
+            if i < self.num_workers:
+                enabled.set()
+            current = multiprocessing.Value("l", 0)
+            p = multiprocessing.Process(target=_worker, args=(self.task_queue, self.done_queue, self.func, self.args, enabled, current))
+            p.start()
+            self.workers.append((p, enabled, current))
+
+    def resize(self, workers):
+        """change the number of workers, within 1..max_workers. A worker that
+        is switched off finishes the chunk it is working on (or the next one
+        it picks up) first."""
+        workers = max(1, min(workers, len(self.workers)))
+        for i, (p, enabled, current) in enumerate(self.workers):
+            if i < workers:
+                enabled.set()
+            else:
+                enabled.clear()
+        self.num_workers = workers
+
+    def stop(self):
+        running = [worker for worker in self.workers if worker[0].is_alive()]
+        for p, enabled, current in running:
+            enabled.set()
+        for p, enabled, current in running:
+            self.task_queue.put('STOP')
+        for p, enabled, current in self.workers:
+            p.join()
+        self.workers = []
+
+    # --- producer side. These may block, so only call them from the producer thread.
+
+    def submit(self, item):
+        self.chunk.append(item)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            chunk, self.chunk = self.chunk, []
+            self.task_queue.put(self._task(chunk))
+
+    def submit_results(self, results):
+        """hand already-finished results straight to the writer"""
+        if results:
+            self.lock.acquire()
+            try:
+                self.submitted = self.submitted + 1
+            finally:
+                self.lock.release()
+            self.done_queue.put((0, results))
+
+    def _task(self, chunk, attempts=1):
+        """count chunk as submitted and return the task to queue for it"""
+        self.lock.acquire()
+        try:
+            chunk_id = self.next_chunk_id
+            self.next_chunk_id = chunk_id + 1
+            self.outstanding[chunk_id] = (chunk, attempts)
+            self.submitted = self.submitted + 1
+        finally:
+            self.lock.release()
+        return (chunk_id, chunk)
+
+    def _untask(self, chunk_id):
+        """take back a task that could not be queued"""
+        self.lock.acquire()
+        try:
+            del self.outstanding[chunk_id]
+            self.submitted = self.submitted - 1
+        finally:
+            self.lock.release()
+
+    def start_producer(self, func, *args, **kargs):
+        """run func(*args, **kargs) in a producer thread. Anything it has not
+        flushed when it returns is flushed for it."""
+        def run():
+            try:
+                try:
+                    func(*args, **kargs)
+                    self.flush()
+                except Exception, e:
+                    self.producer_error = sys.exc_info()
+            finally:
+                self.producer_done = True
+        self.producer_done = False
+        self.producer = threading.Thread(target=run, name="producer")
+        self.producer.setDaemon(True)
+        self.producer.start()
+
+    # --- writer side. Never blocks on the task queue.
+
+    def defer(self, item):
+        """queue work from the writer thread"""
+        self.deferred.append(item)
+
+    def _push_deferred(self):
+        while self.retries:
+            chunk, attempts = self.retries[0]
+            task = self._task(chunk, attempts)
+            try:
+                self.task_queue.put_nowait(task)
+            except Queue.Full, e:
+                self._untask(task[0])
+                return
+            self.retries.popleft()
+        while self.deferred:
+            chunk = []
+            while self.deferred and len(chunk) < self.chunk_size:
+                chunk.append(self.deferred.popleft())
+            task = self._task(chunk)
+            try:
+                self.task_queue.put_nowait(task)
+            except Queue.Full, e:
+                self._untask(task[0])
+                self.deferred.extendleft(reversed(chunk))
+                break
+
+    def _answered(self, chunk_id, results):
+        self.lock.acquire()
+        try:
+            if chunk_id and self.outstanding.pop(chunk_id, None) is None:
+                # a late answer for a chunk that was already given up on
+                return False
+            self.completed = self.completed + 1
+            self.results_written = self.results_written + len(results)
+            return True
+        finally:
+            self.lock.release()
+
+    decorate(traceLog())
+    def check_workers(self):
+        """writer side: notice workers that died, and queue the chunk each of
+        them was working on again (or drop it, after MAX_ATTEMPTS)"""
+        alive = []
+        for worker in self.workers:
+            p, enabled, current = worker
+            if p.is_alive():
+                alive.append(worker)
+                continue
+            p.join()
+            chunk_id = current.value
+            moduleLog.error("Worker process %d died (exit code %s)" % (p.pid, p.exitcode))
+            self.lock.acquire()
+            try:
+                lost = self.outstanding.pop(chunk_id, None)
+            finally:
+                self.lock.release()
+            if lost is None:
+                continue
+            chunk, attempts = lost
+            if attempts < MAX_ATTEMPTS:
+                moduleLog.warning("Handing its chunk of %d items to another worker" % len(chunk))
+                self.retries.append((chunk, attempts + 1))
+            else:
+                moduleLog.error("Giving up on a chunk of %d items that killed %d workers: %s" % (len(chunk), attempts, chunk))
+            # the chunk no longer needs an answer
+            self.lock.acquire()
+            try:
+                self.submitted = self.submitted - 1
+            finally:
+                self.lock.release()
+        if len(alive) < len(self.workers):
+            self.workers = alive
+            if not alive:
+                raise PipelineError("all worker processes died")
+            # keep the pool at its size from the workers left over
+            self.resize(self.num_workers)
+
+    def depths(self):
+        """(chunks waiting for a worker, chunks waiting for the writer,
+        deferred items, chunks submitted but not yet written)"""
+        def qsize(q):
+            try:
+                return q.qsize()
+            except NotImplementedError, e:
+                return -1
+        self.lock.acquire()
+        try:
+            in_flight = self.submitted - self.completed
+        finally:
+            self.lock.release()
+        return (qsize(self.task_queue), qsize(self.done_queue), len(self.deferred), in_flight)
+
+    def _finished(self):
+        if self.producer is not None and not self.producer_done:
+            return False
+        self.lock.acquire()
+        try:
+            return self.completed == self.submitted and not self.deferred and not self.retries
+        finally:
+            self.lock.release()
+
+    decorate(traceLog())
+    def drain(self, write_fn, tick_fn=None, tick_interval=1.0):
+        """consume results in the calling thread, passing each one to
+        write_fn, until the producer is done and every submitted or deferred
+        chunk has been written. tick_fn is called after every chunk and at
+        least every tick_interval seconds while idle. Returns True if any
+        call to write_fn returned True."""
+        wrote_something = False
+        while True:
+            self._push_deferred()
+            if self._finished():
+                break
+            try:
+                chunk_id, results = self.done_queue.get(timeout=tick_interval)
+            except Queue.Empty, e:
+                self.check_workers()
+                if tick_fn is not None:
+                    tick_fn()
+                continue
+            if not self._answered(chunk_id, results):
+                continue
+            for result in results:
+                if write_fn(result):
+                    wrote_something = True
+            if tick_fn is not None:
+                tick_fn()
+
+        if self.producer is not None:
+            self.producer.join()
+            self.producer = None
+            if self.producer_error is not None:
+                error, self.producer_error = self.producer_error, None
+                raise error[0], error[1], error[2]
+        return wrote_something
+
+class WorkerTuner(object):
+    """Grows and shrinks the worker pool of a Pipeline from what it measures.
+    Call tick() from the writer thread, as often as the pipeline's tick_fn
+    runs. Every 'interval' seconds the tuner looks at the results written
+    per second and at how full the task and done queues were on average:
+
+      - done queue mostly full: the writer is the bottleneck and more
+        workers would only pile up results, so shrink. The done queue is
+        bounded, so the writer is never more than queue_depth chunks (plus
+        one per blocked worker) behind.
+      - task queue mostly empty: the workers wait for the walk, leave the
+        pool alone.
+      - otherwise the workers are the bottleneck: add workers as long as
+        that raises the throughput, and take the last step back (and wait a
+        few rounds before trying again) when it does not.
+    """
+    def __init__(self, pipeline, minimum=1, maximum=None, interval=5.0):
+        if maximum is None or maximum > pipeline.max_workers:
+            maximum = pipeline.max_workers
+        self.pipeline = pipeline
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.last_rate = None
+        self.last_change = 0
+        self.hold = 0
+        self.start_window()
+
+    def start_window(self):
+        self.window_start = time.time()
+        self.window_written = self.pipeline.results_written
+        self.samples = 0
+        self.task_fill = 0.0
+        self.done_fill = 0.0
+
+    def tick(self):
+        task, done, deferred, in_flight = self.pipeline.depths()
+        if task >= 0:
+            depth = float(self.pipeline.queue_depth)
+            self.task_fill = self.task_fill + min(task / depth, 1.0)
+            self.done_fill = self.done_fill + min(done / depth, 1.0)
+            self.samples = self.samples + 1
+        elapsed = time.time() - self.window_start
+        if elapsed < self.interval:
+            return
+        if self.samples:
+            rate = (self.pipeline.results_written - self.window_written) / elapsed
+            self.adjust(rate, self.task_fill / self.samples, self.done_fill / self.samples)
+        self.start_window()
+
+    def adjust(self, rate, task_fill, done_fill):
+        workers = self.pipeline.num_workers
+        step = max(1, workers // 4)
+        change = 0
+        if done_fill > 0.75:
+            change = -step
+            reason = "writer backlog"
+        elif task_fill < 0.25:
+            reason = "waiting for work"
+        elif self.last_change > 0 and self.last_rate is not None and rate < self.last_rate * 1.05:
+            change = -self.last_change
+            reason = "no gain from the last increase"
+            self.hold = 3
+        elif self.hold:
+            self.hold = self.hold - 1
+            reason = "holding"
+        else:
+            change = step
+            reason = "workers busy"
+        target = max(self.minimum, min(self.maximum, workers + change))
+        self.last_change = target - workers
+        self.last_rate = rate
+        moduleLogVerbose.debug("worker tuning: %d workers, %.1f results/s, task queue %.0f%% full, done queue %.0f%% full: %s" % (
+            workers, rate, task_fill * 100, done_fill * 100, reason))
+        if target != workers:
+            moduleLogVerbose.info("Changing the number of workers from %d to %d (%s)" % (workers, target, reason))
+            self.pipeline.resize(target)